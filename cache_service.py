@@ -0,0 +1,75 @@
+# cache_service.py
+import os
+import json
+import logging
+from collections import OrderedDict
+
+# Cache limits - configurable via environment variables
+CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_SIZE", "512"))  # Default 512 documents per worker
+CACHE_MAX_CHARS = int(os.getenv("EXTRACTION_CACHE_MAX_CHARS", "20000000"))  # Extracted text held per worker (~20M chars)
+CACHE_TTL_SECONDS = int(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", "86400"))  # Default 24 hours in Redis
+
+# In-process LRU cache: SHA-256 digest -> {"extracted_text": ..., "classification": ...}
+_local_cache = OrderedDict()
+_local_chars = 0  # Total extracted_text characters held in _local_cache
+cache_stats = {"hits": 0, "misses": 0}
+
+# Initialize optional Redis client conditionally
+redis_client = None
+try:
+    if os.getenv("REDIS_URL"):
+        import redis.asyncio as redis
+        redis_client = redis.from_url(os.getenv("REDIS_URL"))
+        logging.info("Redis extraction cache initialized successfully")
+except Exception as e:
+    logging.warning(f"Failed to initialize Redis extraction cache: {e}. Using in-process cache only.")
+    redis_client = None
+
+def _entry_chars(entry: dict) -> int:
+    return len(entry.get("extracted_text") or "")
+
+def _remember(digest: str, entry: dict):
+    # Bounded by total text as well as entry count, since a single document can hold hundreds of thousands of chars
+    global _local_chars
+    previous = _local_cache.pop(digest, None)
+    if previous is not None:
+        _local_chars -= _entry_chars(previous)
+    _local_cache[digest] = entry
+    _local_chars += _entry_chars(entry)
+    while _local_cache and (len(_local_cache) > CACHE_MAX_ENTRIES or _local_chars > CACHE_MAX_CHARS):
+        _, evicted = _local_cache.popitem(last=False)
+        _local_chars -= _entry_chars(evicted)
+
+async def get_cached_result(digest: str) -> dict:
+    """Return the cached extraction/classification entry for a file digest, or None."""
+    entry = _local_cache.get(digest)
+    if entry is not None:
+        _local_cache.move_to_end(digest)
+        cache_stats["hits"] += 1
+        return entry
+
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(f"extract:{digest}")
+            if raw:
+                entry = json.loads(raw)
+                _remember(digest, entry)
+                cache_stats["hits"] += 1
+                return entry
+        except Exception as e:
+            logging.warning(f"Redis cache lookup failed: {e}")
+
+    cache_stats["misses"] += 1
+    return None
+
+async def store_result(digest: str, **fields):
+    """Merge extraction/classification fields into the cache entry for a file digest."""
+    entry = dict(_local_cache.get(digest) or {})
+    entry.update(fields)
+    _remember(digest, entry)
+
+    if redis_client is not None:
+        try:
+            await redis_client.set(f"extract:{digest}", json.dumps(entry), ex=CACHE_TTL_SECONDS)
+        except Exception as e:
+            logging.warning(f"Redis cache store failed: {e}")
@@ -0,0 +1,97 @@
+# gzip_middleware.py
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+
+# Compressed output is coalesced into chunks of at least this size when streaming
+GZIP_BUFFER_SIZE = 8 * 1024  # 8KB
+
+# Incremental streams are sent uncompressed so buffering doesn't delay each event
+UNCOMPRESSED_MEDIA_TYPES = frozenset({"application/x-ndjson", "text/event-stream"})
+
+class ZlibGZipMiddleware:
+    """GZip middleware that compresses with a bare zlib compressor.
+
+    Starlette's GZipMiddleware wraps every response in a GzipFile over a BytesIO. Here a single-message
+    response (every JSON response this app sends) is compressed in one call with no intermediate buffer.
+    """
+
+    def __init__(self, app, minimum_size: int = 2048, compresslevel: int = 1, exclude_paths: tuple = ()):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+        self.exclude_paths = frozenset(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http"
+                and scope["path"] not in self.exclude_paths
+                and "gzip" in Headers(scope=scope).get("Accept-Encoding", "")):
+            responder = _GZipResponder(self, send)
+            await self.app(scope, receive, responder.send)
+        else:
+            await self.app(scope, receive, send)
+
+class _GZipResponder:
+    def __init__(self, middleware: ZlibGZipMiddleware, send):
+        self.middleware = middleware
+        self.downstream_send = send
+        self.initial_message = None
+        self.started = False
+        self.passthrough = False
+        self.compressor = None
+        self.buffer = None
+
+    async def send(self, message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Hold the start message until we know whether the body will be compressed
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";", 1)[0].strip()
+            self.passthrough = "content-encoding" in headers or media_type in UNCOMPRESSED_MEDIA_TYPES
+            return
+        if message_type != "http.response.body" or self.passthrough:
+            if not self.started:
+                self.started = True
+                await self.downstream_send(self.initial_message)
+            await self.downstream_send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            self.started = True
+            if len(body) < self.middleware.minimum_size and not more_body:
+                # Too small to be worth compressing
+                self.passthrough = True
+                await self.downstream_send(self.initial_message)
+                await self.downstream_send(message)
+                return
+
+            self.compressor = zlib.compressobj(self.middleware.compresslevel, zlib.DEFLATED, 31)
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            headers["Content-Encoding"] = "gzip"
+            headers.add_vary_header("Accept-Encoding")
+
+            if not more_body:
+                # Whole response in one message
+                body = self.compressor.compress(body) + self.compressor.flush()
+                headers["Content-Length"] = str(len(body))
+                await self.downstream_send(self.initial_message)
+                await self.downstream_send({"type": "http.response.body", "body": body})
+                return
+
+            # Streaming response: length is unknown until the end
+            del headers["Content-Length"]
+            await self.downstream_send(self.initial_message)
+            self.buffer = bytearray()
+
+        self.buffer += self.compressor.compress(body)
+        if not more_body:
+            self.buffer += self.compressor.flush()
+            await self.downstream_send({"type": "http.response.body", "body": bytes(self.buffer)})
+            self.buffer = None
+        elif len(self.buffer) >= GZIP_BUFFER_SIZE:
+            chunk = bytes(self.buffer)
+            del self.buffer[:]
+            await self.downstream_send({"type": "http.response.body", "body": chunk, "more_body": True})
@@ -1,29 +1,33 @@
 import os
+import io
 import tempfile
 import logging
 import asyncio
 import time
 import signal
 import sys
-import traceback
+import hashlib
+import concurrent.futures
+import multiprocessing
+import orjson
 import psutil
-from pathlib import Path
+from collections import Counter
+from functools import partial
 from typing import List
 from dotenv import load_dotenv
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request as StarletteRequest
-from starlette.responses import Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import textract_service
 import openai_service
+import cache_service
+import semantic_cache
+from gzip_middleware import ZlibGZipMiddleware
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="Document Analysis API")
+app = FastAPI(title="Document Analysis API", default_response_class=ORJSONResponse)
 
 # Enhanced logging configuration with detailed formatting
 logging.basicConfig(
@@ -40,7 +44,11 @@ logger.info(f"Python version: {sys.version}")
 logger.info(f"Process ID: {os.getpid()}")
 logger.info(f"Max file size: {os.getenv('MAX_FILE_SIZE_MB', '100')} MB")
 logger.info(f"Max total size: {os.getenv('MAX_TOTAL_SIZE_MB', '2000')} MB")
+logger.info(f"Spool directory: {os.getenv('SPOOL_DIR', tempfile.gettempdir())}")
 logger.info(f"Request timeout: {os.getenv('REQUEST_TIMEOUT_SECONDS', '1800')} seconds")
+logger.info(f"Max concurrency: {os.getenv('MAX_CONCURRENCY', '8')} files")
+logger.info(f"Classifier concurrency: {os.getenv('CLASSIFIER_CONCURRENCY', '8')}")
+logger.info(f"Extraction workers: {os.getenv('EXTRACT_WORKERS', str(os.cpu_count() or 1))}")
 logger.info("=" * 80)
 
 # File size limits (in bytes) - configurable via environment variables
@@ -51,17 +59,77 @@ MAX_FILES_PER_REQUEST = int(os.getenv("MAX_FILES_PER_REQUEST", "30"))  # Default
 # Request timeout (in seconds) - configurable via environment variables
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT_SECONDS", "1800"))  # 30 minutes default
 
+# Maximum number of files processed concurrently per worker - configurable via environment variables
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))  # Default 8 files in flight
+PROCESSING_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Number of concurrent classification workers per request - configurable via environment variables
+CLASSIFIER_CONCURRENCY = int(os.getenv("CLASSIFIER_CONCURRENCY", "8"))  # Default 8 OpenAI calls in flight
+
+# Text extraction worker processes - configurable via environment variables
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))  # Default one per CPU core
+
+# Created lazily per process: gunicorn --preload imports this module in the master, and a pool made there
+# would have its queues and manager thread shared by every forked worker
+_extract_pool = None
+_extract_pool_pid = None
+
+def get_extract_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Return this worker's extraction process pool, creating it on first use after a fork."""
+    global _extract_pool, _extract_pool_pid
+    if _extract_pool is None or _extract_pool_pid != os.getpid():
+        # Pool processes come from a forkserver rather than forking this worker, whose executor threads may be
+        # holding locks or boto3 connections at that moment
+        _extract_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+        _extract_pool_pid = os.getpid()
+    return _extract_pool
+
+def discard_extract_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    """Drop a broken pool so the next get_extract_pool() starts a new one (no-op if that already happened)."""
+    global _extract_pool
+    if _extract_pool is pool:
+        _extract_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Separator placed between documents in consolidated analysis text
+DOCUMENT_SEPARATOR = "\n\n--- DOCUMENT SEPARATOR ---\n\n"
+
+# Upload spooling chunk size (in bytes)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB per read
+
+# Upload spool directory - the system temp dir by default. Point it at a tmpfs such as /dev/shm only when
+# that mount is sized for MAX_FILE_SIZE x MAX_CONCURRENCY (Docker's default /dev/shm is just 64MB)
+SPOOL_DIR = os.getenv("SPOOL_DIR") or tempfile.gettempdir()
+try:
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    if not os.access(SPOOL_DIR, os.W_OK):
+        raise PermissionError(f"{SPOOL_DIR} is not writable")
+except OSError as e:
+    logger.warning(f"Spool directory unavailable ({e}). Falling back to {tempfile.gettempdir()}")
+    SPOOL_DIR = tempfile.gettempdir()
+
 # Allowed file extensions
-ALLOWED_EXTENSIONS = [".pdf", ".docx", ".csv", ".xlsx", ".png", ".jpg", ".jpeg", ".txt", ".rtf", ".pptx", ".odt"]
+ALLOWED_EXTENSIONS = frozenset({".pdf", ".docx", ".csv", ".xlsx", ".png", ".jpg", ".jpeg", ".txt", ".rtf", ".pptx", ".odt"})
+ALLOWED_EXT_STR = ", ".join(sorted(ALLOWED_EXTENSIONS))
+
+# Process handle reused by log_memory_usage (refreshed after gunicorn forks workers)
+_PROC = psutil.Process(os.getpid())
 
 # Memory monitoring function (defined early so it can be used during startup)
 def log_memory_usage(context: str = ""):
     """Log current memory usage for debugging."""
+    global _PROC
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
-        process = psutil.Process(os.getpid())
-        memory_info = process.memory_info()
+        if _PROC.pid != os.getpid():
+            _PROC = psutil.Process(os.getpid())
+        memory_info = _PROC.memory_info()
         memory_mb = memory_info.rss / 1024 / 1024
-        memory_percent = process.memory_percent()
+        memory_percent = _PROC.memory_percent()
         logger.info(f"Memory usage {context}: {memory_mb:.2f} MB ({memory_percent:.1f}%)")
     except Exception as e:
         logger.warning(f"Could not get memory info: {e}")
@@ -69,30 +137,26 @@ def log_memory_usage(context: str = ""):
 # Log memory at startup
 log_memory_usage("(startup)")
 
-# Global request timeout handler
-class RequestTimeoutHandler:
-    def __init__(self, timeout_seconds: int):
-        self.timeout_seconds = timeout_seconds
-        self.start_time = None
-    
-    def start(self):
-        self.start_time = time.time()
-    
-    def check_timeout(self):
-        if self.start_time and (time.time() - self.start_time) > self.timeout_seconds:
-            raise HTTPException(status_code=408, detail="Request timeout exceeded")
-    
-    def get_remaining_time(self):
-        if self.start_time:
-            return max(0, self.timeout_seconds - (time.time() - self.start_time))
-        return self.timeout_seconds
+def log_cache_usage(context: str = ""):
+    """Log extraction cache hit/miss counters for debugging."""
+    stats = cache_service.cache_stats
+    logger.info(f"Extraction cache {context}: {stats['hits']} hits, {stats['misses']} misses")
+
+# Request timeout wrapper - one timer around the whole endpoint body instead of per-step checks
+async def run_with_timeout(coro, timeout: float = REQUEST_TIMEOUT):
+    """Await an endpoint body under the request timeout, cancelling in-flight work and returning 408 on expiry."""
+    try:
+        return await asyncio.wait_for(coro, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Request timeout exceeded ({timeout:.0f}s)")
+        raise HTTPException(status_code=408, detail="Request timeout exceeded")
 
 # Global exception handler for request entity too large
 @app.exception_handler(413)
 async def request_entity_too_large_handler(request: Request, exc: HTTPException):
     logger.warning(f"Request entity too large: {request.url}")
     log_memory_usage("(413 error)")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=413,
         content={
             "error": "Request Entity Too Large",
@@ -107,17 +171,13 @@ async def request_entity_too_large_handler(request: Request, exc: HTTPException)
 async def global_exception_handler(request: Request, exc: Exception):
     """Catch all unhandled exceptions and log them with full traceback."""
     error_id = time.time()
-    logger.error("=" * 80)
-    logger.error(f"UNHANDLED EXCEPTION [{error_id}]")
-    logger.error(f"URL: {request.method} {request.url}")
-    logger.error(f"Exception type: {type(exc).__name__}")
-    logger.error(f"Exception message: {str(exc)}")
-    logger.error("Full traceback:")
-    logger.error(traceback.format_exc())
+    logger.error(
+        f"UNHANDLED EXCEPTION [{error_id}] on {request.method} {request.url.path}: {type(exc).__name__}: {str(exc)}",
+        exc_info=exc
+    )
     log_memory_usage("(unhandled exception)")
-    logger.error("=" * 80)
     
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "error": "Internal server error",
@@ -126,47 +186,11 @@ async def global_exception_handler(request: Request, exc: Exception):
         }
     )
 
-# Request validation middleware to handle invalid HTTP requests gracefully
-class RequestValidationMiddleware(BaseHTTPMiddleware):
-    """Middleware to catch and handle invalid HTTP requests gracefully."""
-    
-    async def dispatch(self, request: StarletteRequest, call_next):
-        try:
-            # Validate request method
-            if request.method not in ["GET", "POST", "OPTIONS", "HEAD"]:
-                logger.warning(f"Invalid HTTP method: {request.method} for {request.url}")
-                return JSONResponse(
-                    status_code=405,
-                    content={"error": "Method not allowed", "detail": f"Method {request.method} is not allowed"}
-                )
-            
-            # Validate request path (basic sanity check)
-            path = str(request.url.path)
-            if len(path) > 2000:  # Prevent path traversal attacks
-                logger.warning(f"Path too long: {len(path)} characters")
-                return JSONResponse(
-                    status_code=400,
-                    content={"error": "Bad request", "detail": "Request path too long"}
-                )
-            
-            # Process request
-            response = await call_next(request)
-            return response
-            
-        except Exception as e:
-            # Catch any malformed request errors
-            logger.error(f"Request validation error: {str(e)}")
-            logger.error(traceback.format_exc())
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Bad request", "detail": "Invalid HTTP request format"}
-            )
-
-# Add request validation middleware (should be first)
-app.add_middleware(RequestValidationMiddleware)
-
 # Add GZip middleware for better performance with large files
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Level 1 keeps compression CPU low on large JSON responses at a small cost in ratio
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "1"))
+# Health checks return tiny bodies and are hit constantly by the load balancer, so they skip gzip entirely
+app.add_middleware(ZlibGZipMiddleware, minimum_size=2048, compresslevel=GZIP_LEVEL, exclude_paths=("/", "/health"))
 
 # Configure CORS - supports both HTTP and HTTPS
 # Set ALLOWED_ORIGINS environment variable for production (comma-separated)
@@ -187,137 +211,306 @@ app.add_middleware(
     expose_headers=["*"],  # Expose headers for CORS
 )
 
-def validate_file(file: UploadFile):
-    ext = Path(file.filename).suffix.lower()
+def validate_file(file: UploadFile) -> str:
+    """Validate the file extension and return it."""
+    ext = os.path.splitext(file.filename)[1].lower()
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
-            detail=f"Unsupported file type: {ext}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            detail=f"Unsupported file type: {ext}. Allowed types: {ALLOWED_EXT_STR}"
         )
+    return ext
 
-def validate_file_size(file: UploadFile):
-    """Validate file size before processing."""
-    if hasattr(file, 'size') and file.size and file.size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large. Maximum size allowed: {MAX_FILE_SIZE // (1024*1024)}MB"
-        )
-
-def validate_multiple_files_size(files: List[UploadFile]):
-    """Validate total size of multiple files."""
+def validate_batch(files: List[UploadFile]) -> list:
+    """Validate extension, per-file size and total size in one pass; return (file, suffix, size) tuples."""
+    batch = []
     total_size = 0
     for file in files:
-        if hasattr(file, 'size') and file.size:
-            total_size += file.size
+        suffix = validate_file(file)
+        size = getattr(file, 'size', None) or 0
+        if size > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum size allowed: {MAX_FILE_SIZE // (1024*1024)}MB"
+            )
+        total_size += size
         if total_size > MAX_TOTAL_SIZE:
             raise HTTPException(
                 status_code=413,
                 detail=f"Total files size too large. Maximum total size allowed: {MAX_TOTAL_SIZE // (1024*1024)}MB"
             )
+        batch.append((file, suffix, size))
+    return batch
+
+async def spool_to_tmp(upload: UploadFile, suffix: str) -> tuple:
+    """Stream an upload to a temporary file in fixed-size chunks and return its path and SHA-256 digest."""
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=SPOOL_DIR) as tmp:
+        def write_chunk(chunk: bytes):
+            tmp.write(chunk)
+            digest.update(chunk)
+        
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                # Write and hash off the event loop so large uploads don't block other requests
+                await loop.run_in_executor(None, write_chunk, chunk)
+        except BaseException:
+            # Don't leave partial spool files behind
+            os.remove(tmp.name)
+            raise
+    return tmp.name, digest.hexdigest()
 
-async def process_single_file(file: UploadFile, timeout_handler: RequestTimeoutHandler) -> dict:
-    """Process a single file and return analysis results with timeout handling."""
-    tmp_path = None
+async def extract_text(tmp_path: str, digest: str) -> str:
+    """Run text extraction in the worker process pool so OCR and parsing don't block the event loop."""
+    pool = get_extract_pool()
     try:
-        # Check timeout before processing
-        timeout_handler.check_timeout()
+        return await textract_service.extract_text_from_upload_async(tmp_path, pool, digest)
+    except concurrent.futures.process.BrokenProcessPool:
+        # A pool process died (e.g. OOM-killed on a huge scan), which leaves the whole pool unusable
+        logger.warning("Extraction process pool is broken; recreating it and retrying once")
+        discard_extract_pool(pool)
+        return await textract_service.extract_text_from_upload_async(tmp_path, get_extract_pool(), digest)
+
+async def process_single_file(file: UploadFile, suffix: str, include_text: bool = False) -> dict:
+    """Process a single file and return analysis results."""
+    async with PROCESSING_SEMAPHORE:
+        tmp_path = None
+        try:
+            # Stream file to disk in chunks
+            tmp_path, digest = await spool_to_tmp(file, suffix)
         
-        validate_file(file)
-        validate_file_size(file)
-
-        # Save file temporarily to disk
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp:
-            file_bytes = await file.read()
-            tmp.write(file_bytes)
-            tmp_path = tmp.name
+            # 1. Extract text using the hybrid service (skipped for previously seen files)
+            cached = await cache_service.get_cached_result(digest) or {}
+            extracted_text = cached.get("extracted_text")
+            if extracted_text:
+                log_cache_usage(f"(hit - {file.filename})")
+            else:
+                try:
+                    log_memory_usage(f"before text extraction - {file.filename}")
+                    extracted_text = await extract_text(tmp_path, digest)
+                    log_memory_usage(f"after text extraction - {file.filename}")
+                except Exception as e:
+                    logger.exception(f"Text extraction failed for {file.filename}: {str(e)}")
+                    log_memory_usage(f"(text extraction error - {file.filename})")
+                    return {
+                        "filename": file.filename,
+                        "error": f"Text extraction failed: {str(e)}",
+                        "status": "failed"
+                    }
+        
+                if not extracted_text or not extracted_text.strip():
+                    return {
+                        "filename": file.filename,
+                        "error": "Failed to extract meaningful text from document.",
+                        "status": "failed"
+                    }
+                
+                await cache_service.store_result(digest, extracted_text=extracted_text)
 
-        # Check timeout before text extraction
-        timeout_handler.check_timeout()
+            # 2. Perform analysis
+            try:
+                analysis_result = await openai_service.analyze_document(extracted_text)
+            except Exception as e:
+                logger.exception(f"Analysis failed for {file.filename}: {str(e)}")
+                log_memory_usage(f"(analysis error - {file.filename})")
+                return {
+                    "filename": file.filename,
+                    "error": f"Analysis failed: {str(e)}",
+                    "status": "failed"
+                }
         
-        # 1. Extract text using the hybrid service with timeout
-        try:
-            log_memory_usage(f"before text extraction - {file.filename}")
-            extracted_text = textract_service.extract_text_from_upload(tmp_path, file_bytes)
-            log_memory_usage(f"after text extraction - {file.filename}")
-        except Exception as e:
-            logger.error(f"Text extraction failed for {file.filename}: {str(e)}")
-            logger.error(traceback.format_exc())
-            log_memory_usage(f"(text extraction error - {file.filename})")
-            return {
+            # ✅ Ensure analysis_result is a dictionary
+            if not isinstance(analysis_result, dict):
+                logger.warning("OpenAI returned non-dict analysis result. Wrapping it.")
+                analysis_result = {"analysis_output": str(analysis_result)}
+
+            # ✅ Optional debug logging
+            logger.info(f"Successfully processed {file.filename}")
+
+            result = {
                 "filename": file.filename,
-                "error": f"Text extraction failed: {str(e)}",
-                "status": "failed"
+                "analysis": analysis_result,
+                "status": "success"
             }
-        
-        if not extracted_text or not extracted_text.strip():
+            if include_text:
+                result["extracted_text"] = extracted_text[:1000]  # Keep first 1000 chars for reference
+            # Release the full text before the response is serialized
+            extracted_text = None
+            return result
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception(f"Error processing file {file.filename}: {e}")
+            log_memory_usage(f"(processing error - {file.filename})")
             return {
                 "filename": file.filename,
-                "error": "Failed to extract meaningful text from document.",
+                "error": str(e),
                 "status": "failed"
             }
+        finally:
+            # Clean up the temporary file
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        # Check timeout before analysis
-        timeout_handler.check_timeout()
-        
-        # 2. Perform analysis with timeout
+async def extract_file(file: UploadFile, suffix: str) -> dict:
+    """Spool and extract text from a single file, reusing cached results for previously seen files."""
+    async with PROCESSING_SEMAPHORE:
+        tmp_path = None
         try:
-            analysis_result = await asyncio.wait_for(
-                openai_service.analyze_document(extracted_text),
-                timeout=timeout_handler.get_remaining_time()
-            )
-        except asyncio.TimeoutError:
-            logger.error(f"Analysis timeout for {file.filename}")
-            log_memory_usage(f"(analysis timeout - {file.filename})")
+            # Stream file to disk in chunks
+            tmp_path, digest = await spool_to_tmp(file, suffix)
+            
+            # Previously seen files skip extraction and classification
+            cached = await cache_service.get_cached_result(digest) or {}
+            if cached:
+                log_cache_usage(f"(hit - {file.filename})")
+            
+            # Extract text
+            extracted_text = cached.get("extracted_text")
+            if not extracted_text:
+                try:
+                    extracted_text = await extract_text(tmp_path, digest)
+                except Exception as e:
+                    logger.exception(f"Text extraction failed for {file.filename}: {str(e)}")
+                    log_memory_usage(f"(text extraction error - {file.filename})")
+                    return {
+                        "filename": file.filename,
+                        "error": f"Text extraction failed: {str(e)}",
+                        "subcategory": "Extraction Error",
+                        "status": "failed"
+                    }
+                
+                if not extracted_text or not extracted_text.strip():
+                    logger.warning(f"No text extracted from {file.filename}")
+                    return {
+                        "filename": file.filename,
+                        "error": "No text extracted from document",
+                        "subcategory": "No Text",
+                        "status": "failed"
+                    }
+                
+                await cache_service.store_result(digest, extracted_text=extracted_text)
+            
             return {
                 "filename": file.filename,
-                "error": "Analysis timeout - document too complex",
-                "status": "failed"
+                "digest": digest,
+                "extracted_text": extracted_text,
+                "classification": cached.get("classification"),
+                "status": "success"
             }
+        
+        except HTTPException:
+            raise
         except Exception as e:
-            logger.error(f"Analysis failed for {file.filename}: {str(e)}")
-            logger.error(traceback.format_exc())
-            log_memory_usage(f"(analysis error - {file.filename})")
+            logger.exception(f"Error processing file {file.filename}: {e}")
+            log_memory_usage(f"(processing error - {file.filename})")
             return {
                 "filename": file.filename,
-                "error": f"Analysis failed: {str(e)}",
-                "status": "failed"
+                "error": f"Processing error: {str(e)}",
+                "subcategory": "Processing Error",
+                "status": "error"
             }
-        
-        # ✅ Ensure analysis_result is a dictionary
-        if not isinstance(analysis_result, dict):
-            logger.warning("OpenAI returned non-dict analysis result. Wrapping it.")
-            analysis_result = {"analysis_output": str(analysis_result)}
-
-        # ✅ Optional debug logging
-        logger.info(f"Successfully processed {file.filename}")
-
-        return {
-            "filename": file.filename,
-            "analysis": analysis_result,
-            "status": "success",
-            "extracted_text": extracted_text[:1000]  # Keep first 1000 chars for reference
-        }
+        finally:
+            # Clean up temporary file
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    except HTTPException:
-        raise
+async def classify_extracted(extracted: dict) -> dict:
+    """Classify a successfully extracted file, reusing a cached classification when available."""
+    filename = extracted["filename"]
+    digest = extracted.pop("digest")
+    if extracted.get("classification"):
+        return extracted
+    
+    extracted_text = extracted["extracted_text"]
+    try:
+        classification = await openai_service.classify_document(extracted_text)
     except Exception as e:
-        logger.error(f"Error processing file {file.filename}: {e}")
-        logger.error(traceback.format_exc())
-        log_memory_usage(f"(processing error - {file.filename})")
+        logger.exception(f"Classification failed for {filename}: {str(e)}")
+        log_memory_usage(f"(classification error - {filename})")
         return {
-            "filename": file.filename,
-            "error": str(e),
+            "filename": filename,
+            "error": f"Classification failed: {str(e)}",
+            "subcategory": "Classification Error",
             "status": "failed"
         }
-    finally:
-        # Clean up the temporary file
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+    
+    # Fallback classifications (all OpenAI attempts failed) report zero confidence and aren't cached
+    if classification.get("confidence", 0.0) > 0.0:
+        await cache_service.store_result(digest, extracted_text=extracted_text, classification=classification)
+    
+    extracted["classification"] = classification
+    return extracted
+
+async def run_classification_pipeline(batch: list) -> list:
+    """Extract and classify validated files as a producer-consumer pipeline and return results in upload order.
+    
+    Extraction (CPU-bound, process pool) feeds a queue drained by CLASSIFIER_CONCURRENCY classification
+    workers (network-bound, OpenAI), so classifying one file overlaps extracting the next.
+    """
+    queue = asyncio.Queue()
+    results = [None] * len(batch)
+    
+    async def extract_into_queue(index: int, file: UploadFile, suffix: str):
+        await queue.put((index, await extract_file(file, suffix)))
+    
+    async def producer():
+        try:
+            return await asyncio.gather(
+                *(extract_into_queue(i, file, suffix) for i, (file, suffix, _) in enumerate(batch)),
+                return_exceptions=True
+            )
+        finally:
+            # One stop signal per classification worker
+            for _ in range(CLASSIFIER_CONCURRENCY):
+                queue.put_nowait(None)
+    
+    async def consumer():
+        while (item := await queue.get()) is not None:
+            index, extracted = item
+            if extracted.get("status") == "success":
+                extracted = await classify_extracted(extracted)
+            results[index] = extracted
+    
+    extract_errors, *_ = await asyncio.gather(
+        producer(),
+        *(consumer() for _ in range(CLASSIFIER_CONCURRENCY))
+    )
+    
+    for i, ((file, _, _), error) in enumerate(zip(batch, extract_errors)):
+        if isinstance(error, BaseException):
+            logger.error(f"Error processing file {file.filename}: {error}")
+            results[i] = {
+                "filename": file.filename,
+                "error": f"Processing error: {str(error)}",
+                "status": "error"
+            }
+    return results
+
+async def gather_file_results(batch: list, worker) -> list:
+    """Run a per-file coroutine for every validated file concurrently and return results in upload order."""
+    results = await asyncio.gather(
+        *(worker(file, suffix) for file, suffix, _ in batch),
+        return_exceptions=True
+    )
+    
+    gathered = []
+    for (file, _, _), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Error processing file {file.filename}: {result}")
+            result = {
+                "filename": file.filename,
+                "error": f"Processing error: {str(result)}",
+                "status": "error"
+            }
+        gathered.append(result)
+    return gathered
 
-async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
+async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> StreamingResponse:
     """Analyze multiple files together and provide a single consolidated analysis with timeout handling."""
-    timeout_handler = RequestTimeoutHandler(REQUEST_TIMEOUT)
-    timeout_handler.start()
+    start_time = time.monotonic()
     
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
@@ -325,7 +518,7 @@ async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
     if len(files) > MAX_FILES_PER_REQUEST:  # Limit to prevent abuse
         raise HTTPException(status_code=400, detail=f"Maximum {MAX_FILES_PER_REQUEST} files allowed per request")
     
-    validate_multiple_files_size(files)
+    batch = validate_batch(files)
     
     # Process all files to extract text and classify
     file_results = []
@@ -333,136 +526,99 @@ async def analyze_multiple_files_consolidated(files: List[UploadFile]) -> dict:
     file_info = []
     categories = []
     
-    logger.info(f"Starting to process {len(files)} files")
+    logger.info(f"Starting to process {len(files)} files (concurrency: {MAX_CONCURRENCY})")
     
-    for i, file in enumerate(files):
-        # Check timeout for each file
-        timeout_handler.check_timeout()
+    for result in await run_with_timeout(run_classification_pipeline(batch)):
+        if result.get("status") != "success":
+            continue
         
-        logger.info(f"Processing file {i+1}/{len(files)}: {file.filename}")
+        filename = result["filename"]
+        extracted_text = result.pop("extracted_text")
+        category = result["classification"].get("category", "GENERAL")
+        categories.append(category)
         
-        # Extract text and classify document
-        tmp_path = None
-        try:
-            validate_file(file)
-            validate_file_size(file)
-            
-            # Save file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp:
-                file_bytes = await file.read()
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-            
-            # Extract text
-            try:
-                extracted_text = textract_service.extract_text_from_upload(tmp_path, file_bytes)
-            except Exception as e:
-                logger.error(f"Text extraction failed for {file.filename}: {str(e)}")
-                logger.error(traceback.format_exc())
-                log_memory_usage(f"(text extraction error - {file.filename})")
-                continue
-            
-            if not extracted_text or not extracted_text.strip():
-                logger.warning(f"No text extracted from {file.filename}")
-                continue
-            
-            # Classify document
-            try:
-                classification = await asyncio.wait_for(
-                    openai_service.classify_document(extracted_text),
-                    timeout=timeout_handler.get_remaining_time()
-                )
-                category = classification.get("category", "GENERAL")
-                categories.append(category)
-                
-                file_results.append({
-                    "filename": file.filename,
-                    "text_length": len(extracted_text),
-                    "category": category,
-                    "status": "success"
-                })
-                all_texts.append(extracted_text)
-                file_info.append({
-                    "filename": file.filename,
-                    "text_length": len(extracted_text),
-                    "category": category
-                })
-                
-                logger.info(f"Successfully processed {file.filename} - classified as {category} - extracted {len(extracted_text)} characters")
-                
-            except asyncio.TimeoutError:
-                logger.error(f"Classification timeout for {file.filename}")
-                continue
-            except Exception as e:
-                logger.error(f"Classification failed for {file.filename}: {str(e)}")
-                logger.error(traceback.format_exc())
-                log_memory_usage(f"(classification error - {file.filename})")
-                continue
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error processing file {file.filename}: {e}")
-            logger.error(traceback.format_exc())
-            log_memory_usage(f"(processing error - {file.filename})")
-            continue
-        finally:
-            # Clean up temporary file
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
+        file_results.append({
+            "filename": filename,
+            "text_length": len(extracted_text),
+            "category": category,
+            "status": "success"
+        })
+        all_texts.append(extracted_text)
+        file_info.append({
+            "filename": filename,
+            "text_length": len(extracted_text),
+            "category": category
+        })
+        
+        logger.info(f"Successfully processed {filename} - classified as {category} - extracted {len(extracted_text)} characters")
     
     logger.info(f"Completed file processing: {len(file_results)} successful, {len(files) - len(file_results)} failed")
     
     if not file_results:
         raise HTTPException(status_code=422, detail="No files could be processed successfully")
     
-    # Check timeout before consolidated analysis
-    timeout_handler.check_timeout()
-    
     # Combine all extracted texts for consolidated analysis
-    combined_text = "\n\n--- DOCUMENT SEPARATOR ---\n\n".join(all_texts)
+    # Build into a buffer, dropping each source text as it is copied to keep peak memory down
+    extracted_text = None
+    buffer = io.StringIO()
+    for i in range(len(all_texts)):
+        if i:
+            buffer.write(DOCUMENT_SEPARATOR)
+        buffer.write(all_texts[i])
+        all_texts[i] = None
+    all_texts.clear()
+    combined_text = buffer.getvalue()
+    del buffer
     unique_categories = list(set(categories))
     
-    # Since classification groups documents by category, we expect same-category analysis
-    category = unique_categories[0] if unique_categories else "UNKNOWN"
+    # Since classification groups documents by category, we expect same-category analysis; a mixed batch is
+    # analyzed as its most common category, and the same value is reported to the client
+    category = Counter(categories).most_common(1)[0][0] if categories else "UNKNOWN"
     
     logger.info(f"Starting consolidated analysis with {len(combined_text)} total characters")
     logger.info(f"Category: {category}")
     logger.info(f"Document categories: {unique_categories}")
     
-    # Perform consolidated analysis using OpenAI with timeout
-    try:
-        logger.info(f"Calling OpenAI API for consolidated analysis...")
-        consolidated_analysis = await asyncio.wait_for(
-            openai_service.analyze_multiple_documents_consolidated(
-                combined_text, 
-                file_info,
-                categories
-            ),
-            timeout=timeout_handler.get_remaining_time()
-        )
-        logger.info(f"OpenAI API call completed successfully")
-        
-        return {
+    # Stream the consolidated analysis as NDJSON: metadata first, then LLM output as it is generated
+    async def stream_consolidated_analysis():
+        yield orjson.dumps({
+            "event": "metadata",
             "total_files": len(files),
             "successful_files": len(file_results),
             "failed_files": len(files) - len(file_results),
             "file_info": file_info,
             "document_categories": unique_categories,
-            "category": category,
-            "consolidated_analysis": consolidated_analysis,
-            "status": "success",
-            "processing_time": time.time() - timeout_handler.start_time
-        }
+            "category": category
+        }) + b"\n"
         
-    except asyncio.TimeoutError:
-        logger.error("Consolidated analysis timeout")
-        raise HTTPException(status_code=408, detail="Analysis timeout - too many complex documents")
-    except Exception as e:
-        logger.error(f"Error in consolidated analysis: {e}")
-        logger.error(traceback.format_exc())
-        log_memory_usage("(consolidated analysis error)")
-        raise HTTPException(status_code=500, detail=f"Consolidated analysis failed: {str(e)}")
+        logger.info(f"Calling OpenAI API for consolidated analysis...")
+        deltas = openai_service.analyze_multiple_documents_consolidated(combined_text, file_info, category)
+        try:
+            while True:
+                try:
+                    # The stream outlives the handler, so the remaining request budget is enforced per chunk
+                    remaining = max(0, REQUEST_TIMEOUT - (time.monotonic() - start_time))
+                    delta = await asyncio.wait_for(deltas.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                yield orjson.dumps({"event": "delta", "content": delta}) + b"\n"
+            logger.info(f"OpenAI API call completed successfully")
+            yield orjson.dumps({
+                "event": "done",
+                "status": "success",
+                "processing_time": time.monotonic() - start_time
+            }) + b"\n"
+        except asyncio.TimeoutError:
+            logger.error("Consolidated analysis timeout")
+            yield orjson.dumps({"event": "error", "status_code": 408, "detail": "Analysis timeout - too many complex documents"}) + b"\n"
+        except Exception as e:
+            logger.exception(f"Error in consolidated analysis: {e}")
+            log_memory_usage("(consolidated analysis error)")
+            yield orjson.dumps({"event": "error", "status_code": 500, "detail": f"Consolidated analysis failed: {str(e)}"}) + b"\n"
+        finally:
+            await deltas.aclose()
+    
+    return StreamingResponse(stream_consolidated_analysis(), media_type="application/x-ndjson")
 
 @app.get("/", status_code=200)
 async def root():
@@ -475,23 +631,22 @@ async def health_check():
     return {"status": "ok", "timestamp": time.time()}
 
 @app.post("/analyze")
-async def analyze_single(file: UploadFile = File(...)):
+async def analyze_single(file: UploadFile = File(...), include_text: bool = False):
     """Analyze a single document with timeout handling."""
-    timeout_handler = RequestTimeoutHandler(REQUEST_TIMEOUT)
-    timeout_handler.start()
+    start_time = time.monotonic()
     
-    result = await process_single_file(file, timeout_handler)
+    [(file, suffix, _)] = validate_batch([file])
+    result = await run_with_timeout(process_single_file(file, suffix, include_text=include_text))
     if result.get("status") == "failed":
         raise HTTPException(status_code=500, detail=result.get("error", "Unknown error"))
     
-    result["processing_time"] = time.time() - timeout_handler.start_time
+    result["processing_time"] = time.monotonic() - start_time
     return result
 
 @app.post("/analyze-multiple")
-async def analyze_multiple(files: List[UploadFile] = File(...)):
+async def analyze_multiple(files: List[UploadFile] = File(...), include_text: bool = False):
     """Analyze multiple documents individually with timeout handling."""
-    timeout_handler = RequestTimeoutHandler(REQUEST_TIMEOUT)
-    timeout_handler.start()
+    start_time = time.monotonic()
     
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
@@ -499,16 +654,12 @@ async def analyze_multiple(files: List[UploadFile] = File(...)):
     if len(files) > MAX_FILES_PER_REQUEST:  # Limit to prevent abuse
         raise HTTPException(status_code=400, detail=f"Maximum {MAX_FILES_PER_REQUEST} files allowed per request")
     
-    validate_multiple_files_size(files)
+    batch = validate_batch(files)
     
-    # Process all files with timeout handling
-    results = []
-    for file in files:
-        # Check timeout for each file
-        timeout_handler.check_timeout()
-        
-        result = await process_single_file(file, timeout_handler)
-        results.append(result)
+    # Process all files concurrently with timeout handling
+    results = await run_with_timeout(
+        gather_file_results(batch, partial(process_single_file, include_text=include_text))
+    )
     
     # Count successes and failures
     successful = sum(1 for r in results if r.get("status") == "success")
@@ -519,7 +670,7 @@ async def analyze_multiple(files: List[UploadFile] = File(...)):
         "successful": successful,
         "failed": failed,
         "results": results,
-        "processing_time": time.time() - timeout_handler.start_time
+        "processing_time": time.monotonic() - start_time
     }
 
 @app.post("/analyze-consolidated")
@@ -530,8 +681,7 @@ async def analyze_consolidated(files: List[UploadFile] = File(...)):
 @app.post("/classify-documents") 
 async def classify_documents(files: List[UploadFile] = File(...)):
     """Step 1: Classify bulk documents into categories/channels."""
-    timeout_handler = RequestTimeoutHandler(REQUEST_TIMEOUT)
-    timeout_handler.start()
+    start_time = time.monotonic()
     
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
@@ -539,141 +689,60 @@ async def classify_documents(files: List[UploadFile] = File(...)):
     if len(files) > MAX_FILES_PER_REQUEST:
         raise HTTPException(status_code=400, detail=f"Maximum {MAX_FILES_PER_REQUEST} files allowed per request")
     
-    validate_multiple_files_size(files)
+    batch = validate_batch(files)
     
     # Process all files to extract text and classify
     classification_results = []
     channel_summary = {}
     
-    logger.info(f"Starting classification of {len(files)} files")
+    logger.info(f"Starting classification of {len(files)} files (concurrency: {MAX_CONCURRENCY})")
     
-    for i, file in enumerate(files):
-        # Check timeout for each file
-        timeout_handler.check_timeout()
-        
-        logger.info(f"Classifying file {i+1}/{len(files)}: {file.filename}")
-        
-        # Extract text from file
-        tmp_path = None
-        try:
-            validate_file(file)
-            validate_file_size(file)
-            
-            # Save file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp:
-                file_bytes = await file.read()
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-            
-            # Extract text
-            try:
-                extracted_text = textract_service.extract_text_from_upload(tmp_path, file_bytes)
-            except Exception as e:
-                logger.error(f"Text extraction failed for {file.filename}: {str(e)}")
-                logger.error(traceback.format_exc())
-                log_memory_usage(f"(text extraction error - {file.filename})")
-                classification_results.append({
-                    "filename": file.filename,
-                    "category": "UNCLASSIFIABLE",
-                    "confidence": 0.0,
-                    "reasoning": f"Text extraction failed: {str(e)}",
-                    "subcategory": "Extraction Error",
-                    "status": "failed"
-                })
-                continue
-            
-            if not extracted_text or not extracted_text.strip():
-                classification_results.append({
-                    "filename": file.filename,
-                    "category": "UNCLASSIFIABLE",
-                    "confidence": 0.0,
-                    "reasoning": "No text extracted from document",
-                    "subcategory": "No Text",
-                    "status": "failed"
-                })
-                continue
-            
-            # Classify document
-            try:
-                classification = await asyncio.wait_for(
-                    openai_service.classify_document(extracted_text),
-                    timeout=timeout_handler.get_remaining_time()
-                )
-                
-                classification_results.append({
-                    "filename": file.filename,
-                    "category": classification.get("category", "GENERAL"),
-                    "confidence": classification.get("confidence", 0.5),
-                    "reasoning": classification.get("reasoning", "Classification completed"),
-                    "subcategory": classification.get("subcategory", "Unknown"),
-                    "status": "success"
-                })
-                
-                # Update channel summary
-                category = classification.get("category", "GENERAL")
-                if category not in channel_summary:
-                    channel_summary[category] = {
-                        "count": 0,
-                        "files": [],
-                        "avg_confidence": 0.0,
-                        "subcategories": {}
-                    }
-                
-                channel_summary[category]["count"] += 1
-                channel_summary[category]["files"].append(file.filename)
-                channel_summary[category]["avg_confidence"] = (
-                    (channel_summary[category]["avg_confidence"] * (channel_summary[category]["count"] - 1) + 
-                     classification.get("confidence", 0.5)) / channel_summary[category]["count"]
-                )
-                
-                subcategory = classification.get("subcategory", "Unknown")
-                if subcategory not in channel_summary[category]["subcategories"]:
-                    channel_summary[category]["subcategories"][subcategory] = 0
-                channel_summary[category]["subcategories"][subcategory] += 1
-                
-                logger.info(f"Classified {file.filename} as {category} (confidence: {classification.get('confidence', 0.5)})")
-                
-            except asyncio.TimeoutError:
-                logger.error(f"Classification timeout for {file.filename}")
-                classification_results.append({
-                    "filename": file.filename,
-                    "category": "UNCLASSIFIABLE",
-                    "confidence": 0.0,
-                    "reasoning": "Classification timeout",
-                    "subcategory": "Timeout",
-                    "status": "timeout"
-                })
-            except Exception as e:
-                logger.error(f"Classification failed for {file.filename}: {str(e)}")
-                logger.error(traceback.format_exc())
-                log_memory_usage(f"(classification error - {file.filename})")
-                classification_results.append({
-                    "filename": file.filename,
-                    "category": "UNCLASSIFIABLE",
-                    "confidence": 0.0,
-                    "reasoning": f"Classification failed: {str(e)}",
-                    "subcategory": "Classification Error",
-                    "status": "failed"
-                })
+    for result in await run_with_timeout(run_classification_pipeline(batch)):
+        filename = result["filename"]
         
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Error processing file {file.filename}: {e}")
-            logger.error(traceback.format_exc())
-            log_memory_usage(f"(processing error - {file.filename})")
+        if result.get("status") != "success":
             classification_results.append({
-                "filename": file.filename,
+                "filename": filename,
                 "category": "UNCLASSIFIABLE",
                 "confidence": 0.0,
-                "reasoning": f"Processing error: {str(e)}",
-                "subcategory": "Processing Error",
-                "status": "error"
+                "reasoning": result.get("error", "Unknown error"),
+                "subcategory": result.get("subcategory", "Processing Error"),
+                "status": result.get("status", "failed")
             })
-        finally:
-            # Clean up temporary file
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            continue
+        
+        classification = result["classification"]
+        classification_results.append({
+            "filename": filename,
+            "category": classification.get("category", "GENERAL"),
+            "confidence": classification.get("confidence", 0.5),
+            "reasoning": classification.get("reasoning", "Classification completed"),
+            "subcategory": classification.get("subcategory", "Unknown"),
+            "status": "success"
+        })
+        
+        # Update channel summary (averages are computed once after the loop)
+        category = classification.get("category", "GENERAL")
+        entry = channel_summary.get(category)
+        if entry is None:
+            entry = channel_summary[category] = {
+                "count": 0,
+                "sum_confidence": 0.0,
+                "files": [],
+                "subcategories": Counter()
+            }
+        
+        entry["count"] += 1
+        entry["sum_confidence"] += classification.get("confidence", 0.5)
+        entry["files"].append(filename)
+        entry["subcategories"][classification.get("subcategory", "Unknown")] += 1
+        
+        logger.info(f"Classified {filename} as {category} (confidence: {classification.get('confidence', 0.5)})")
+    
+    # Finalize channel summary averages
+    for entry in channel_summary.values():
+        entry["avg_confidence"] = entry.pop("sum_confidence") / entry["count"]
+        entry["subcategories"] = dict(entry["subcategories"])
     
     # Count successes and failures
     successful = sum(1 for r in classification_results if r.get("status") == "success")
@@ -689,7 +758,7 @@ async def classify_documents(files: List[UploadFile] = File(...)):
         "channel_summary": channel_summary,
         "available_channels": list(channel_summary.keys()),
         "status": "success",
-        "processing_time": time.time() - timeout_handler.start_time
+        "processing_time": time.monotonic() - start_time
     }
 
 
@@ -698,11 +767,19 @@ async def classify_documents(files: List[UploadFile] = File(...)):
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"])
 async def catch_all(path: str, request: Request):
     """Catch-all route handler for invalid paths to prevent worker crashes from vulnerability scanners."""
+    # Oversized paths can only land here; request line limits are enforced by nginx/the server
+    if len(path) > 2000:
+        logger.warning(f"Path too long: {len(path)} characters")
+        return ORJSONResponse(
+            status_code=400,
+            content={"error": "Bad request", "detail": "Request path too long"}
+        )
+    
     logger.warning(f"Invalid path requested: {request.method} {request.url.path}")
     logger.warning(f"Client IP: {request.client.host if request.client else 'unknown'}")
     
     # Return proper 404 JSON response instead of letting it crash
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=404,
         content={
             "error": "Not Found",
@@ -722,7 +799,10 @@ async def catch_all(path: str, request: Request):
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Application shutting down...")
+    await semantic_cache.response_cache.flush()
+    if _extract_pool is not None and _extract_pool_pid == os.getpid():
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, h11_max_incomplete_event_size=16384)
\ No newline at end of file
@@ -1,198 +1,598 @@
 # openai_service.py
 import os
-import json
+import re
+import time
+import string
+import asyncio
 import logging
-from openai import AsyncOpenAI
+import random
+import inspect
+import functools
+from collections import defaultdict
+from typing import AsyncIterator
+import httpx
+import tiktoken
+import orjson
+import numpy as np
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from prompts import ANALYSIS_PROMPTS, DOCUMENT_CLASSIFICATION_PROMPT, SINGLE_DOCUMENT_PROMPTS
+from semantic_cache import SEMANTIC_CACHE_ENABLED, response_cache, text_digest
+
+# Concurrency limits - configurable via environment variables
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "20"))  # OpenAI requests in flight per worker
+OPENAI_MIN_TOKEN_HEADROOM = int(os.getenv("OPENAI_MIN_TOKEN_HEADROOM", "8000"))  # Pause below this many remaining TPM tokens
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))  # Read timeout for non-streamed completions
+_sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+_BLANK_LINES = re.compile(r"\n{3,}")
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+_MODEL_FIELD = re.compile(rb'"model"\s*:\s*"([^"]+)"')
+
+def _compact_prompt(prompt: str) -> str:
+    """Collapse runs of blank lines and trim surrounding whitespace, which would otherwise cost prompt tokens."""
+    return _BLANK_LINES.sub("\n\n", prompt).strip()
+
+def _parse_reset(value: str) -> float:
+    """Convert an x-ratelimit-reset-* value such as "6m0s" or "20ms" to seconds."""
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_PART.findall(value or ""))
+
+class _RateLimitBudget:
+    """Token bucket for one model, refilled from the x-ratelimit-* headers OpenAI returns on every response.
+
+    When the remaining request or token budget runs out, new requests wait for the reported reset
+    instead of tripping 429s partway through a batch.
+    """
+
+    def __init__(self):
+        self.resume_at = 0.0
+
+    def update(self, headers):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        delay = 0.0
+        if remaining_requests is not None and int(remaining_requests) <= 0:
+            delay = _parse_reset(headers.get("x-ratelimit-reset-requests"))
+        if remaining_tokens is not None and int(remaining_tokens) < OPENAI_MIN_TOKEN_HEADROOM:
+            delay = max(delay, _parse_reset(headers.get("x-ratelimit-reset-tokens")))
+        if delay:
+            self.resume_at = max(self.resume_at, time.monotonic() + min(delay, MAX_RETRY_DELAY))
+
+    async def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            logging.info(f"OpenAI rate limit budget exhausted, waiting {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# Limits are per model, so a nearly exhausted gpt-4o budget doesn't hold back gpt-4o-mini or embedding calls
+_rate_limits = defaultdict(_RateLimitBudget)
+
+async def _record_rate_limits(response):
+    if "x-ratelimit-remaining-requests" not in response.headers and "x-ratelimit-remaining-tokens" not in response.headers:
+        return
+    try:
+        match = _MODEL_FIELD.search(response.request.content)
+    except httpx.RequestNotRead:  # Streamed uploads (e.g. Batch API files) carry no model
+        return
+    if match is None:
+        return
+    try:
+        _rate_limits[match.group(1).decode()].update(response.headers)
+    except ValueError as e:
+        logging.debug(f"Unparseable rate limit headers: {e}")
 
 # Load OpenAI credentials
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are handled by _call_with_retry, so the SDK's own retry loop is disabled.
+# One shared keep-alive pool (HTTP/2 multiplexed) amortizes TLS handshakes across concurrent requests.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0),
+        http2=True,
+        event_hooks={"response": [_record_rate_limits]}
+    )
+)
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
-MAX_RETRIES = 3
+OPENAI_CLASSIFY_MODEL = os.getenv("OPENAI_CLASSIFY_MODEL", "gpt-4o-mini")  # Cheaper model for the 10-category classification
+CHARS_PER_TOKEN = 4  # Rough average for English prose, used where exact token counts aren't worth computing
+
+class _ApproximateEncoding:
+    """Stand-in for a tiktoken encoding that treats every CHARS_PER_TOKEN characters as one token."""
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
 
+try:
+    try:
+        _ENCODING = tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        _ENCODING = tiktoken.get_encoding("o200k_base")  # gpt-4o family tokenizer
+except Exception as e:
+    # The encoding file is downloaded on first use, which fails on hosts without outbound access
+    logging.warning(f"Failed to load tiktoken encoding, budgeting by character count instead: {e}")
+    _ENCODING = _ApproximateEncoding()
+CLASSIFY_MAX_CHARS = 4000  # Category signal is almost always on the first page
+CLASSIFY_MAX_TOKENS = 256  # Classification JSON is well under 200 tokens
+
+# Text shorter than this, or with fewer printable characters than this ratio, isn't sent to OpenAI
+MIN_MEANINGFUL_CHARS = 50
+MIN_PRINTABLE_RATIO = 0.7
+MAX_RETRIES = 6
+
+# Retry backoff (seconds) and the HTTP statuses worth retrying
+MAX_RETRY_DELAY = 60
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Batch API polling (seconds) - batches complete within a 24h window, so polling backs off up to 10 minutes
+BATCH_POLL_INITIAL_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 600
+
+async def analyze_documents_batch(jobs: list) -> dict:
+    """Run chat completion jobs through the OpenAI Batch API and return parsed JSON results keyed by custom_id.
+
+    Each job is {"custom_id": str, "body": dict of chat completion parameters}. Batch requests are billed at
+    roughly half the real-time price and don't count against the RPM limit, at the cost of up to 24h latency.
+    """
+    logging.info(f"Submitting batch of {len(jobs)} requests to OpenAI...")
+    lines = [
+        orjson.dumps({"custom_id": job["custom_id"], "method": "POST", "url": "/v1/chat/completions", "body": job["body"]})
+        for job in jobs
+    ]
+    batch_file = await _call_with_retry(
+        lambda: client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch"),
+        "batch upload"
+    )
+    batch = await _call_with_retry(
+        lambda: client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h"),
+        "batch submission"
+    )
+    logging.info(f"Batch {batch.id} submitted")
+
+    delay = BATCH_POLL_INITIAL_SECONDS
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+        batch = await _call_with_retry(lambda: client.batches.retrieve(batch.id), "batch status")
+        logging.info(f"Batch {batch.id} status: {batch.status}")
+
+    if batch.status != "completed" or not batch.output_file_id:
+        logging.error(f"Batch {batch.id} did not complete: {batch.status}")
+        return {}
+
+    output = await _call_with_retry(lambda: client.files.content(batch.output_file_id), "batch download")
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        try:
+            content = record["response"]["body"]["choices"][0]["message"]["content"]
+            results[record["custom_id"]] = orjson.loads(content)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logging.warning(f"Batch request {record.get('custom_id')} failed: {e}")
+    return results
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Honor Retry-After on rate limits; otherwise back off exponentially with jitter."""
+    if getattr(error, "status_code", None) == 429:
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return min(MAX_RETRY_DELAY, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return min(MAX_RETRY_DELAY, 2 ** attempt + random.uniform(0, 1))
+
+async def _call_with_retry(request_factory, description: str, model: str = None):
+    """Await an OpenAI request, retrying transient connection/status errors with exponential backoff and jitter.
+
+    Requests are limited to OPENAI_CONCURRENCY in flight and, when model is given, held back while that model's
+    rate limit budget is exhausted.
+    Transport errors raised while reading a streamed body (e.g. httpx.ReadTimeout, RemoteProtocolError) are retried too,
+    so a factory that opens and drains a stream retries the whole generation.
+    Non-retryable API errors (e.g. 400, 401) and programming errors are raised immediately.
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if model:
+                await _rate_limits[model].wait()
+            async with _sem:
+                logging.info(f"Attempt {attempt}: Sending {description} request to OpenAI...")
+                return await request_factory()
+        except (openai.APIConnectionError, openai.APIStatusError, httpx.TransportError) as e:
+            status_code = getattr(e, "status_code", None)
+            if attempt == MAX_RETRIES or (status_code is not None and status_code not in RETRYABLE_STATUS_CODES):
+                raise
+            delay = _retry_delay(e, attempt)
+            logging.warning(f"{description.capitalize()} attempt {attempt} failed ({status_code or type(e).__name__}): {e}. Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def _embed(text: str):
+    """Return a unit-normalized embedding of the leading text, or None if the embedding call fails."""
+    try:
+        await _rate_limits[OPENAI_EMBEDDING_MODEL].wait()
+        response = await client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=text[:8000])
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        logging.warning(f"Embedding request failed, skipping semantic cache: {e}")
+        return None
+
+def cached_response(name: str, is_cacheable, use_embeddings: bool = True):
+    """Cache a document-level OpenAI call by exact text hash and, when enabled, by embedding similarity.
+
+    Results are partitioned by (function name, category) so a cached analysis is only reused for the same
+    kind of request. Fallback results (failed calls) are never stored.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(text: str, *args, **kwargs):
+            # Bound by name so only a real category parameter (not e.g. a mode flag) selects the partition
+            partition = (name, signature.bind(text, *args, **kwargs).arguments.get("category"))
+            digest = text_digest(text)
+            cached = response_cache.get_exact(partition, digest)
+            if cached is not None:
+                logging.info(f"Exact cache hit for {name}")
+                return cached
+
+            vector = None
+            if use_embeddings and SEMANTIC_CACHE_ENABLED:
+                vector = await _embed(text)
+                if vector is not None:
+                    cached = response_cache.get_similar(partition, vector)
+                    if cached is not None:
+                        return cached
+
+            result = await func(text, *args, **kwargs)
+            if isinstance(result, dict) and is_cacheable(result):
+                response_cache.store(partition, digest, vector, result)
+            return result
+        return wrapper
+    return decorator
+
+def _is_trivial_text(text: str) -> bool:
+    """True for text too short or too garbled (e.g. binary noise from a broken file) to be worth a model call."""
+    stripped = text.strip()
+    if len(stripped) < MIN_MEANINGFUL_CHARS:
+        return True
+    sample = stripped[:CLASSIFY_MAX_CHARS]
+    printable = sum(c.isprintable() or c.isspace() for c in sample)
+    return printable / len(sample) < MIN_PRINTABLE_RATIO
+
+def skip_trivial_text(result: dict):
+    """Return a copy of result straight away for trivial text instead of calling the wrapped OpenAI function."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(text: str, *args, **kwargs):
+            if _is_trivial_text(text):
+                logging.info(f"Skipping {func.__name__}: text too short or non-printable")
+                return dict(result)
+            return await func(text, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Results returned without a model call for trivial text, and when classification or analysis fails
+_TRIVIAL_CLASSIFICATION = {"category": "UNCLASSIFIABLE", "confidence": 1.0, "reasoning": "Text too short or non-printable", "subcategory": "Blank/Corrupt"}
+_TRIVIAL_ANALYSIS = {"document_type": "Blank/Corrupt", "detailed_summary": "Text too short or non-printable to analyze.", "actionable_recommendations": []}
+_FAILED_CLASSIFICATION = {"category": "GENERAL", "confidence": 0.0, "reasoning": "Classification failed", "subcategory": "Unknown"}
+_FAILED_ANALYSIS = {"error": "Failed to analyze document."}
+
+def _classification_request(text: str) -> dict:
+    """Chat completion parameters for classifying a document."""
+    return dict(
+        model=OPENAI_CLASSIFY_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": DOCUMENT_CLASSIFICATION_PROMPT},
+            {"role": "user", "content": text[:CLASSIFY_MAX_CHARS]}
+        ],
+        temperature=0.2,  # Balanced temperature for consistent category classification but varied subcategory generation
+        max_tokens=CLASSIFY_MAX_TOKENS
+    )
+
+@skip_trivial_text(_TRIVIAL_CLASSIFICATION)
+@cached_response("classify_document", lambda result: result.get("reasoning") != "Classification failed")
 async def classify_document(text: str) -> dict:
     """Classify a document into predefined categories."""
     logging.info("Classifying document...")
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            logging.info(f"Attempt {attempt}: Sending classification request to OpenAI...")
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": DOCUMENT_CLASSIFICATION_PROMPT},
-                    {"role": "user", "content": text}
-                ],
-                temperature=0.2  # Balanced temperature for consistent category classification but varied subcategory generation
-            )
-            content = response.choices[0].message.content.strip()
-            logging.debug(f"OpenAI classification response: {content}")
-            result = json.loads(content)
-
-            if isinstance(result, dict) and "category" in result:
-                return result
-            else:
-                logging.warning("Unexpected classification format.")
-                return {"category": "GENERAL", "confidence": 0.5, "reasoning": "Classification failed", "subcategory": "Unknown"}
+    request = _classification_request(text)
 
-        except Exception as e:
-            logging.warning(f"Classification attempt {attempt} failed: {e}")
-    
-    logging.error("All classification attempts failed.")
-    return {"category": "GENERAL", "confidence": 0.0, "reasoning": "Classification failed", "subcategory": "Unknown"}
+    try:
+        response = await _call_with_retry(lambda: client.chat.completions.create(**request), "classification", request["model"])
+        content = response.choices[0].message.content.strip()
+        logging.debug(f"OpenAI classification response: {content}")
+        result = orjson.loads(content)
+    except (openai.OpenAIError, orjson.JSONDecodeError) as e:
+        logging.error(f"All classification attempts failed: {e}")
+        return dict(_FAILED_CLASSIFICATION)
 
+    if isinstance(result, dict) and "category" in result:
+        return result
+    logging.warning("Unexpected classification format.")
+    return {"category": "GENERAL", "confidence": 0.5, "reasoning": "Classification failed", "subcategory": "Unknown"}
 
-async def analyze_document(text: str, category: str = None, subcategory: str = None) -> dict:
-    """Analyze a single document using the appropriate prompt based on context."""
-    logging.info("Analyzing single document...")
-    
+
+def _analysis_request(text: str, category: str = None) -> dict:
+    """Chat completion parameters for a single-document analysis."""
     # Choose the appropriate prompt based on whether category is provided
     if category:
         # Use channel/consolidated analysis prompt for pre-classified documents
         system_prompt = ANALYSIS_PROMPTS
-        analysis_prompt = f"""
-You are analyzing a document that has been classified as {category}.
+        analysis_prompt = _compact_prompt(f"""You are analyzing a document that has been classified as {category}.
 
 Please provide a detailed analysis focusing on {category}-specific aspects and requirements.
 
 Document text to analyze:
 {text}
 
-IMPORTANT: Focus on {category}-specific details, requirements, deadlines, and compliance issues. Extract relevant key details for {category} documents.
-"""
+IMPORTANT: Focus on {category}-specific details, requirements, deadlines, and compliance issues. Extract relevant key details for {category} documents.""")
     else:
         # Use single document analysis prompt for unclassified documents
         system_prompt = SINGLE_DOCUMENT_PROMPTS
         analysis_prompt = text
     
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            logging.info(f"Attempt {attempt}: Sending analysis request to OpenAI...")
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": analysis_prompt}
-                ],
-                temperature=0.2
-            )
-            content = response.choices[0].message.content.strip()
-            logging.debug(f"OpenAI response: {content}")
-            result = json.loads(content)
-
-            if isinstance(result, dict):
-                return result
-            else:
-                logging.warning("Unexpected analysis format.")
-                return {"result": str(result)}
+    return dict(
+        model=OPENAI_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": analysis_prompt}
+        ],
+        temperature=0.2
+    )
 
-        except Exception as e:
-            logging.warning(f"Attempt {attempt} failed: {e}")
-    logging.error("All analysis attempts failed.")
-    return {"error": "Failed to analyze document."}
+async def _stream_to_completion(request: dict) -> str:
+    """Open a chat completion stream and return its full content once generation finishes."""
+    stream = await client.chat.completions.create(**request, stream=True)
+    return "".join([chunk.choices[0].delta.content async for chunk in stream if chunk.choices and chunk.choices[0].delta.content])
 
-async def analyze_multiple_documents_consolidated(combined_text: str, file_info: list, categories: list = None) -> dict:
-    """Analyze multiple documents together and provide a single consolidated analysis."""
-    logging.info(f"Performing consolidated analysis of {len(file_info)} documents")
-    
-    # Log the analysis start
-    logging.info(f"Starting consolidated analysis for {len(file_info)} documents")
-    logging.info(f"Total combined text length: {len(combined_text)} characters")
+# Near-duplicate documents (e.g. recurring invoices) differ in exactly the amounts and dates analysis extracts,
+# so analysis results are only reused for byte-identical text
+@skip_trivial_text(_TRIVIAL_ANALYSIS)
+@cached_response("analyze_document", lambda result: "error" not in result, use_embeddings=False)
+async def analyze_document(text: str, category: str = None, subcategory: str = None) -> dict:
+    """Analyze a single document using the appropriate prompt based on context."""
+    logging.info("Analyzing single document...")
+    request = _analysis_request(text, category)
 
-    # Smart text sampling for better analysis
-    if len(combined_text) > 50000:
-        # For very large text, use smart sampling to get representative content
-        # Take first 25,000 chars (beginning of documents) and last 25,000 chars (end of documents)
-        first_part = combined_text[:25000]
-        last_part = combined_text[-25000:]
-        text_sample = first_part + "\n\n[... MIDDLE CONTENT TRUNCATED ...]\n\n" + last_part
-        logging.info(f"Using smart sampling: {len(text_sample)} characters (first 25k + last 25k of {len(combined_text)} total)")
-    else:
-        # For smaller text, use all content
-        text_sample = combined_text
-        logging.info(f"Using all {len(text_sample)} characters for analysis")
-    
-    # Use the enhanced ANALYSIS_PROMPTS for consolidated analysis with category information
-    category_info = ""
-    analysis_focus = ""
-    
-    if categories:
-        unique_categories = list(set(categories))
-        # Since classification groups documents by category, we expect same-category analysis
-        single_category = unique_categories[0]
-        category_info = f"""
-The documents have been classified as {single_category} documents.
-
-Focus your analysis specifically on {single_category}-related aspects, requirements, deadlines, and compliance issues.
-"""
-        analysis_focus = f"""
-IMPORTANT: Focus on {single_category}-specific details, requirements, deadlines, and compliance issues. Provide specific, actionable recommendations with exact amounts, dates, and regulatory requirements.
-
-Extract {single_category}-specific key details from the combined text:
-- If {single_category} is PAYMENTS: Extract invoice_number, due_date, total_amount, currency, sender_name, receiver_name, iban, payment_reference
-- If {single_category} is VAT: Extract vat_id_number, tax_authority, reporting_period, submission_deadline, tax_due_amount, form_name
-- If {single_category} is LEGAL: Extract contract_parties, effective_date, expiration_date, renewal_terms
-- If {single_category} is REGISTRATION: Extract company_name, registration_number, issuing_authority, date_of_issue
-- If {single_category} is FINANCIAL: Extract account_balance, transaction_summary, financial_period, bank_name
-- If {single_category} is INSURANCE: Extract policy_number, coverage_type, premium_amount, renewal_date, insurer_name
-- If {single_category} is CERTIFICATES: Extract certificate_type, issuing_authority, validity_period, certificate_number
-- If {single_category} is TAX: Extract tax_type, tax_period, tax_amount, filing_deadline, tax_authority
-- If {single_category} is GENERAL: Extract sender_name, subject, contact_person, relevant_dates
-"""
-    
-    consolidated_prompt = f"""
-You are analyzing {len(file_info)} documents that have been classified as the same category.
-{category_info}
-Focus your analysis on providing comprehensive insights for this specific document category.
+    try:
+        # Streamed so a long generation never sits idle past the read timeout; parsed once complete.
+        # Opening and draining the stream is one retried unit, so a connection dropped mid-generation starts over.
+        content = (await _call_with_retry(lambda: _stream_to_completion(request), "analysis", request["model"])).strip()
+        logging.debug(f"OpenAI response: {content}")
+        result = orjson.loads(content)
+    except (openai.OpenAIError, httpx.HTTPError, orjson.JSONDecodeError) as e:
+        logging.error(f"All analysis attempts failed: {e}")
+        return dict(_FAILED_ANALYSIS)
 
-Document Information:
-{json.dumps(file_info, indent=2)}
+    if isinstance(result, dict):
+        return result
+    logging.warning("Unexpected analysis format.")
+    return {"result": str(result)}
+
+# Tokens of document text sent for consolidated analysis - configurable via environment variables
+CONSOLIDATED_TOKEN_BUDGET = int(os.getenv("CONSOLIDATED_TOKEN_BUDGET", "90000"))
+TRUNCATION_MARKER = "\n\n[... MIDDLE CONTENT TRUNCATED ...]\n\n"
+
+def _encode(text: str) -> list:
+    # Document text is data, so special-token strings in it are encoded as ordinary text
+    return _ENCODING.encode(text, disallowed_special=())
+
+def _head_and_tail(tokens: list, budget: int) -> str:
+    """Keep the first and last budget/2 tokens, where headers, totals and deadlines usually sit."""
+    if len(tokens) <= budget:
+        return _ENCODING.decode(tokens)
+    half = budget // 2
+    return _ENCODING.decode(tokens[:half]) + TRUNCATION_MARKER + _ENCODING.decode(tokens[len(tokens) - half:])
+
+def _token_shares(sizes: list, budget: int) -> list:
+    """Split budget so documents smaller than an even share keep all their tokens and larger ones split the rest evenly."""
+    shares = list(sizes)
+    remaining = budget
+    pending = sorted(range(len(sizes)), key=lambda index: sizes[index])
+    for position, index in enumerate(pending):
+        share = remaining // (len(pending) - position)
+        if sizes[index] > share:
+            # Every document from here on is at least this large, so they all get the same share
+            for larger in pending[position:]:
+                shares[larger] = share
+            break
+        remaining -= sizes[index]
+    return shares
+
+def _sample_documents(combined_text: str, combined_tokens: list, file_info: list) -> str:
+    """Fit combined text into CONSOLIDATED_TOKEN_BUDGET without dropping any document.
+
+    Short documents are kept whole and the remaining budget is shared evenly by the longer ones (see _token_shares).
+
+    Documents are located in combined_text from their text_length in file_info. Falls back to a head/tail
+    slice of the whole text if those lengths don't line up with it.
+    """
+    lengths = [info.get("text_length", 0) for info in file_info]
+    gaps = len(combined_text) - sum(lengths)
+    if not sum(lengths) or gaps < 0 or (len(lengths) == 1 and gaps) or (len(lengths) > 1 and gaps % (len(lengths) - 1)):
+        logging.warning("Document lengths don't match the combined text; sampling it as a whole")
+        return _head_and_tail(combined_tokens, CONSOLIDATED_TOKEN_BUDGET)
+
+    separator_length = gaps // (len(lengths) - 1) if len(lengths) > 1 else 0
+    separator = combined_text[lengths[0]:lengths[0] + separator_length]
+    documents = []
+    position = 0
+    for length in lengths:
+        documents.append(_encode(combined_text[position:position + length]))
+        position += length + separator_length
+    shares = _token_shares([len(tokens) for tokens in documents], CONSOLIDATED_TOKEN_BUDGET)
+    return separator.join(_head_and_tail(tokens, share) for tokens, share in zip(documents, shares))
+
+# Key details extracted per category in consolidated analysis
+_CATEGORY_KEY_DETAILS = {
+    "PAYMENTS": "invoice_number, due_date, total_amount, currency, sender_name, receiver_name, iban, payment_reference",
+    "VAT": "vat_id_number, tax_authority, reporting_period, submission_deadline, tax_due_amount, form_name",
+    "LEGAL": "contract_parties, effective_date, expiration_date, renewal_terms",
+    "REGISTRATION": "company_name, registration_number, issuing_authority, date_of_issue",
+    "FINANCIAL": "account_balance, transaction_summary, financial_period, bank_name",
+    "INSURANCE": "policy_number, coverage_type, premium_amount, renewal_date, insurer_name",
+    "CERTIFICATES": "certificate_type, issuing_authority, validity_period, certificate_number",
+    "TAX": "tax_type, tax_period, tax_amount, filing_deadline, tax_authority",
+    "GENERAL": "sender_name, subject, contact_person, relevant_dates",
+}
+
+def _consolidated_system_prompt(category: str = None) -> str:
+    """System message for consolidated analysis: the shared analysis prompt followed by the category rubric."""
+    prompt = ANALYSIS_PROMPTS + """
+Focus your analysis on providing comprehensive insights for this specific document category.
 
 Please provide a comprehensive analysis focusing on:
 1. **Comprehensive Summary**: Detailed summary of all documents combined with specific details, amounts, dates, and entities
 2. **Key Findings**: Specific findings from the document collection
 3. **Detailed Recommendations**: Specific recommendations with exact details and next steps
 4. **Priority Actions**: Most urgent actions that need immediate attention with specific details
+"""
+    if not category:
+        return prompt
+    prompt += f"""
+The documents have been classified as {category} documents.
 
-Analyze the following combined text from all documents:
-{text_sample}
+Focus your analysis specifically on {category}-related aspects, requirements, deadlines, and compliance issues.
 
-{analysis_focus}
+IMPORTANT: Focus on {category}-specific details, requirements, deadlines, and compliance issues. Provide specific, actionable recommendations with exact amounts, dates, and regulatory requirements.
+"""
+    if category in _CATEGORY_KEY_DETAILS:
+        prompt += f"""
+Extract {category}-specific key details from the combined text: {_CATEGORY_KEY_DETAILS[category]}
 """
+    return prompt
 
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            logging.info(f"Attempt {attempt}: Sending consolidated analysis request to OpenAI...")
-            logging.info(f"Prompt length: {len(consolidated_prompt)} characters")
-            logging.info(f"Text sample length: {len(text_sample)} characters")
-            
-            response = await client.chat.completions.create(
-                model=OPENAI_MODEL,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": ANALYSIS_PROMPTS},
-                    {"role": "user", "content": consolidated_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=3000
-            )
-            content = response.choices[0].message.content.strip()
-            logging.debug(f"OpenAI consolidated analysis response: {content}")
-            result = json.loads(content)
-
-            if isinstance(result, dict):
-                return result
+# User message for consolidated analysis; the static text is parsed once at import
+_CONSOLIDATED_PROMPT = string.Template("""You are analyzing $document_count documents that have been classified as the same category.
+
+Document Information:
+$file_info
+
+Analyze the following combined text from all documents:
+$text_sample""")
+
+# Built once at import so each category's system message is a byte-identical prefix OpenAI can serve from its prompt cache
+_CATEGORY_RUBRIC = {None: _compact_prompt(_consolidated_system_prompt())}
+_CATEGORY_RUBRIC.update({category: _compact_prompt(_consolidated_system_prompt(category)) for category in _CATEGORY_KEY_DETAILS})
+
+async def _classify_and_analyze(text: str) -> dict:
+    # Analysis uses the single-document prompt, so it doesn't need to wait for the classification
+    classification, analysis = await asyncio.gather(classify_document(text), analyze_document(text))
+    return {"classification": classification, "analysis": analysis}
+
+async def classify_and_analyze_many(docs: list, mode: str = "realtime") -> list:
+    """Classify and analyze many document texts concurrently, returning results in input order.
+
+    Requests fan out across all documents and are throttled by OPENAI_CONCURRENCY and the rate limit budget.
+    A failed document yields its exception in place of a result.
+    mode="batch" sends every request in one Batch API job instead, for offline backlogs that can wait up to 24h.
+    """
+    if mode == "batch":
+        return await _classify_and_analyze_batch(docs)
+    logging.info(f"Classifying and analyzing {len(docs)} documents...")
+    return await asyncio.gather(*[_classify_and_analyze(text) for text in docs], return_exceptions=True)
+
+async def _classify_and_analyze_batch(docs: list) -> list:
+    """classify_and_analyze_many through the Batch API, sharing the trivial-text checks and exact response cache."""
+    jobs = []
+    for index, text in enumerate(docs):
+        if _is_trivial_text(text):
+            continue
+        digest = text_digest(text)
+        if response_cache.get_exact(("classify_document", None), digest) is None:
+            jobs.append({"custom_id": f"classify-{index}", "body": _classification_request(text)})
+        if response_cache.get_exact(("analyze_document", None), digest) is None:
+            jobs.append({"custom_id": f"analyze-{index}", "body": _analysis_request(text)})
+    batch_results = await analyze_documents_batch(jobs) if jobs else {}
+
+    results = []
+    for index, text in enumerate(docs):
+        if _is_trivial_text(text):
+            results.append({"classification": dict(_TRIVIAL_CLASSIFICATION), "analysis": dict(_TRIVIAL_ANALYSIS)})
+            continue
+        digest = text_digest(text)
+        classification = response_cache.get_exact(("classify_document", None), digest)
+        if classification is None:
+            classification = batch_results.get(f"classify-{index}")
+            if isinstance(classification, dict) and "category" in classification:
+                response_cache.store(("classify_document", None), digest, None, classification)
             else:
-                logging.warning("Unexpected consolidated analysis format.")
-                return {"comprehensive_summary": "Analysis completed but format was unexpected", "detailed_recommendations": ["Please check document format"]}
-
-        except Exception as e:
-            logging.error(f"Attempt {attempt} failed with error: {str(e)}")
-            logging.error(f"Error type: {type(e).__name__}")
-            if hasattr(e, '__traceback__'):
-                import traceback
-                logging.error(f"Full traceback: {traceback.format_exc()}")
+                classification = dict(_FAILED_CLASSIFICATION)
+        analysis = response_cache.get_exact(("analyze_document", None), digest)
+        if analysis is None:
+            analysis = batch_results.get(f"analyze-{index}")
+            if isinstance(analysis, dict):
+                response_cache.store(("analyze_document", None), digest, None, analysis)
+            else:
+                analysis = dict(_FAILED_ANALYSIS)
+        results.append({"classification": classification, "analysis": analysis})
+    return results
+
+async def analyze_multiple_documents_consolidated(combined_text: str, file_info: list, category: str = None) -> AsyncIterator[str]:
+    """Analyze multiple documents of one category together, yielding the consolidated JSON analysis as it is generated."""
+    logging.info(f"Performing consolidated analysis of {len(file_info)} documents")
+    
+    # Log the analysis start
+    logging.info(f"Starting consolidated analysis for {len(file_info)} documents")
+    logging.info(f"Total combined text length: {len(combined_text)} characters")
+
+    # Smart text sampling for better analysis, budgeted in tokens since chars/token varies widely (prose vs tables)
+    # Tokenizing up to a few MB of text takes long enough to stall the event loop, so it runs in a thread
+    combined_tokens = await asyncio.to_thread(_encode, combined_text)
+    if len(combined_tokens) > CONSOLIDATED_TOKEN_BUDGET:
+        # For very large text, keep short documents whole and split the rest of the budget among the longer ones
+        text_sample = await asyncio.to_thread(_sample_documents, combined_text, combined_tokens, file_info)
+        logging.info(f"Using smart sampling: {len(text_sample)} characters of {len(combined_text)} total ({len(combined_tokens)} tokens)")
+    else:
+        # For smaller text, use all content
+        text_sample = combined_text
+        logging.info(f"Using all {len(text_sample)} characters ({len(combined_tokens)} tokens) for analysis")
+    sample_tokens = min(len(combined_tokens), CONSOLIDATED_TOKEN_BUDGET)
+    del combined_tokens
+    
+    # Static instructions go in the system message so the prefix is identical across calls of the same
+    # category; only the document-specific content varies in the user message
+    system_prompt = _CATEGORY_RUBRIC.get(category) or _compact_prompt(_consolidated_system_prompt(category))
+    # Compact JSON and collapsed blank lines keep whitespace from spending prompt tokens
+    consolidated_prompt = _CONSOLIDATED_PROMPT.substitute(
+        document_count=len(file_info),
+        file_info=orjson.dumps(file_info).decode(),
+        text_sample=_compact_prompt(text_sample)
+    )
+
+    logging.info(f"Prompt length: {len(consolidated_prompt)} characters")
+    logging.info(f"Text sample length: {len(text_sample)} characters")
+    # Estimated from the sample's token count rather than re-tokenizing the prompt on the event loop
+    instruction_chars = len(system_prompt) + len(consolidated_prompt) - len(text_sample)
+    logging.info(f"Input tokens: ~{sample_tokens + max(instruction_chars, 0) // CHARS_PER_TOKEN}")
+    request = dict(
+        model=OPENAI_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": consolidated_prompt}
+        ],
+        temperature=0.3,
+        max_tokens=3000,
+        stream=True
+    )
+    try:
+        stream = await _call_with_retry(lambda: client.chat.completions.create(**request), "consolidated analysis", request["model"])
+    except openai.OpenAIError as e:
+        logging.exception(f"All consolidated analysis attempts failed ({type(e).__name__}): {str(e)}")
+        yield orjson.dumps({"comprehensive_summary": "Failed to analyze documents", "detailed_recommendations": ["Please try again or check document format"]}).decode()
+        return
     
-    logging.error("All consolidated analysis attempts failed.")
-    return {"comprehensive_summary": "Failed to analyze documents", "detailed_recommendations": ["Please try again or check document format"]}
+    # Once output has started flowing it can't be retried; errors propagate to the caller
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
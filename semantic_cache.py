@@ -0,0 +1,184 @@
+# semantic_cache.py
+import os
+import copy
+import fcntl
+import pickle
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+# Semantic cache settings - configurable via environment variables
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"  # Embedding lookups are opt-in
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "5000"))  # Entries kept per (function, category)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH")  # Optional file the cache is persisted to
+SEMANTIC_CACHE_FLUSH_SECONDS = int(os.getenv("SEMANTIC_CACHE_FLUSH_SECONDS", "300"))  # Max delay before new entries are persisted
+
+# Embedding matrix capacity grows in steps of this many rows instead of being copied on every insert
+VECTOR_CHUNK_ROWS = 1024
+
+def text_digest(text: str) -> str:
+    """Exact-match key for a document text."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+class _Partition:
+    """Cached results for one (function, category) pair: exact digests plus normalized embeddings."""
+
+    def __init__(self):
+        self.results = OrderedDict()  # digest -> result
+        self.digests = []  # row i of vectors belongs to digests[i]
+        self.rows = {}  # digest -> row in vectors
+        self.vectors = None  # (capacity, dim) float32 matrix of unit vectors; rows past len(digests) are unused
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "rows" not in state:  # Files written before rows were tracked
+            self.rows = {digest: row for row, digest in enumerate(self.digests)}
+
+    def add(self, digest: str, vector, result: dict):
+        self.results[digest] = result
+        self.results.move_to_end(digest)
+        if vector is not None and digest not in self.rows:
+            self._append_row(digest, vector)
+        while len(self.results) > SEMANTIC_CACHE_SIZE:
+            evicted, _ = self.results.popitem(last=False)
+            if evicted in self.rows:
+                self._remove_row(evicted)
+
+    def vector(self, digest: str):
+        row = self.rows.get(digest)
+        return None if row is None else self.vectors[row]
+
+    def _append_row(self, digest: str, vector):
+        count = len(self.digests)
+        if self.vectors is None:
+            self.vectors = np.empty((VECTOR_CHUNK_ROWS, vector.shape[0]), dtype=np.float32)
+        elif count == self.vectors.shape[0]:
+            grown = np.empty((count + VECTOR_CHUNK_ROWS, self.vectors.shape[1]), dtype=np.float32)
+            grown[:count] = self.vectors
+            self.vectors = grown
+        self.vectors[count] = vector
+        self.rows[digest] = count
+        self.digests.append(digest)
+
+    def _remove_row(self, digest: str):
+        # Move the last row into the freed slot so removal is O(dim) instead of copying the matrix
+        row = self.rows.pop(digest)
+        last = len(self.digests) - 1
+        if row != last:
+            moved = self.digests[last]
+            self.vectors[row] = self.vectors[last]
+            self.digests[row] = moved
+            self.rows[moved] = row
+        self.digests.pop()
+
+    def nearest(self, vector):
+        if not self.digests:
+            return None, 0.0
+        # Inner product of unit vectors == cosine similarity
+        similarities = self.vectors[:len(self.digests)] @ vector
+        best = int(np.argmax(similarities))
+        return self.digests[best], float(similarities[best])
+
+    def snapshot(self) -> "_Partition":
+        """Copy that can be pickled in another thread while this partition keeps changing."""
+        copied = _Partition()
+        copied.results = OrderedDict(self.results)
+        copied.digests = list(self.digests)
+        copied.rows = dict(self.rows)
+        copied.vectors = None if self.vectors is None else self.vectors[:len(self.digests)].copy()
+        return copied
+
+class ResponseCache:
+    """Response cache for OpenAI calls with an exact-hash fast path and an embedding-similarity fallback.
+
+    New entries are persisted in batches by a background flush, at most SEMANTIC_CACHE_FLUSH_SECONDS after
+    they are stored and on shutdown. Each flush merges with the file under a lock, so workers sharing the
+    file add to it instead of overwriting each other.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.partitions = {}
+        self._dirty = False
+        self._flush_handle = None
+        self._flush_task = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.partitions = pickle.load(f)
+                logging.info(f"Loaded semantic cache from {path}")
+            except Exception as e:
+                logging.warning(f"Failed to load semantic cache from {path}: {e}")
+
+    def get_exact(self, partition: tuple, digest: str) -> dict:
+        entries = self.partitions.get(partition)
+        if entries is None or digest not in entries.results:
+            return None
+        entries.results.move_to_end(digest)
+        return copy.deepcopy(entries.results[digest])
+
+    def get_similar(self, partition: tuple, vector) -> dict:
+        entries = self.partitions.get(partition)
+        if entries is None:
+            return None
+        digest, similarity = entries.nearest(vector)
+        if digest is None or similarity < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        logging.info(f"Semantic cache hit for {partition[0]} (similarity {similarity:.3f})")
+        return copy.deepcopy(entries.results[digest])
+
+    def store(self, partition: tuple, digest: str, vector, result: dict):
+        self.partitions.setdefault(partition, _Partition()).add(digest, vector, copy.deepcopy(result))
+        if self.path:
+            self._dirty = True
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(SEMANTIC_CACHE_FLUSH_SECONDS, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Persist entries stored since the last flush, pickling in a worker thread."""
+        if not self.path or not self._dirty:
+            return
+        self._dirty = False
+        snapshot = {partition: entries.snapshot() for partition, entries in self.partitions.items()}
+        await asyncio.to_thread(self._persist, snapshot)
+
+    def _persist(self, partitions: dict):
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                merged = self._load_for_merge()
+                # Entries from this worker are newer than what's on disk, so they're added last
+                for partition, entries in partitions.items():
+                    target = merged.setdefault(partition, _Partition())
+                    for digest, result in entries.results.items():
+                        target.add(digest, entries.vector(digest), result)
+                with tempfile.NamedTemporaryFile(delete=False, dir=directory) as tmp:
+                    pickle.dump(merged, tmp)
+                os.replace(tmp.name, self.path)
+        except Exception as e:
+            logging.warning(f"Failed to persist semantic cache to {self.path}: {e}")
+
+    def _load_for_merge(self) -> dict:
+        try:
+            with open(self.path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning(f"Discarding unreadable semantic cache file {self.path}: {e}")
+            return {}
+
+response_cache = ResponseCache(SEMANTIC_CACHE_PATH)
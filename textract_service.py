@@ -1,18 +1,67 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import io
 import os
+import mmap
+import time
+import uuid
+import hashlib
+import tempfile
+import asyncio
 import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-import pdfplumber
+import pypdfium2 as pdfium
+import openpyxl
 import pandas as pd
 from docx import Document
 from PIL import Image
-from io import BytesIO
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoRegionError, NoCredentialsError
 
+# Extraction limits - configurable via environment variables
+# Consolidated analysis budgets document text in tokens (see openai_service), so by default a single document may
+# fill that budget at ~4 characters per token before extraction stops
+MAX_EXTRACTED_CHARS = int(os.getenv("MAX_EXTRACTED_CHARS") or 4 * int(os.getenv("CONSOLIDATED_TOKEN_BUDGET", "90000")))
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "0")) or None  # Optional cap on PDF pages opened (0 = no cap)
+MAX_TABLE_ROWS = int(os.getenv("MAX_TABLE_ROWS", "5000"))  # Rows read from a CSV/XLSX sheet
+CSV_CHUNK_ROWS = 1000
+OCR_PAGE_CONCURRENCY = int(os.getenv("OCR_PAGE_CONCURRENCY", "10"))  # Scanned PDF pages sent to Textract at once
+OCR_RENDER_SCALE = 300 / 72  # Rasterize at 300 DPI for OCR; small print loses accuracy much below that
+OCR_JPEG_QUALITY = 90  # Used for rendered pages whose PNG exceeds the Textract size limit
+TEXTRACT_MAX_BYTES = 10 * 1024 * 1024  # Textract synchronous API document limit
+
+# Asynchronous Textract jobs for multi-page/oversized files (requires an S3 bucket the credentials can write to)
+OCR_BUCKET = os.getenv("OCR_BUCKET")
+ASYNC_TEXTRACT_EXTENSIONS = frozenset({".pdf", ".tiff", ".png", ".jpg", ".jpeg"})
+TEXTRACT_POLL_MAX_SECONDS = 30
+TEXTRACT_JOB_TIMEOUT_SECONDS = int(os.getenv("TEXTRACT_JOB_TIMEOUT_SECONDS", "900"))
+
+# Images only wait on Textract, so batch extraction runs them in threads rather than the process pool
+OCR_ONLY_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".tiff", ".bmp"})
+OCR_BATCH_CONCURRENCY = int(os.getenv("OCR_BATCH_CONCURRENCY", "10"))  # Image OCR calls in flight per batch
+
+# PDFium isn't thread-safe, even across separate documents, so every call into it in this process is serialized
+_PDFIUM_LOCK = threading.Lock()
+
+# Optional on-disk cache of extracted text keyed by file content; shared by all workers on the host
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR")
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB, for callers that don't pass a digest
+
+# Textract connection pool - sized for concurrent OCR calls, with adaptive client-side retry throttling
+TEXTRACT_CONFIG = Config(
+    max_pool_connections=int(os.getenv("TEXTRACT_MAX_CONNECTIONS", "64")),
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    connect_timeout=5,
+    read_timeout=30
+)
+
 # Initialize AWS Textract client conditionally
 textract_client = None
+s3_client = None
 try:
     if (os.getenv("AWS_ACCESS_KEY_ID") and 
         os.getenv("AWS_SECRET_ACCESS_KEY") and 
@@ -22,101 +71,288 @@ try:
             "textract",
             aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION")
+            region_name=os.getenv("AWS_REGION"),
+            config=TEXTRACT_CONFIG
         )
         logging.info("AWS Textract client initialized successfully")
+
+        if OCR_BUCKET:
+            s3_client = boto3.client(
+                "s3",
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                region_name=os.getenv("AWS_REGION"),
+                config=TEXTRACT_CONFIG
+            )
+            logging.info(f"Asynchronous Textract enabled via S3 bucket {OCR_BUCKET}")
     else:
         logging.warning("AWS credentials not found. Textract OCR will not be available.")
         logging.warning("Set AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, and AWS_REGION environment variables")
 except Exception as e:
     logging.warning(f"Failed to initialize AWS Textract client: {e}")
     textract_client = None
+    s3_client = None
 
-def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
-    """Extracts text from various formats. Falls back to AWS Textract OCR for scanned documents/images."""
+def _rows_to_text(rows) -> str:
+    """Render table rows as tab-separated lines, stopping once MAX_EXTRACTED_CHARS have been produced."""
+    lines = []
+    total_chars = 0
+    for row in rows:
+        line = "\t".join("" if value is None else str(value) for value in row)
+        lines.append(line)
+        total_chars += len(line) + 1
+        if total_chars >= MAX_EXTRACTED_CHARS:
+            logging.info(f"Collected {total_chars} characters after {len(lines)} rows; skipping the rest.")
+            break
+    return "\n".join(lines)
 
-    ext = file_path.lower()
+def _iter_csv_rows(file_path: str):
+    reader = pd.read_csv(file_path, dtype=str, keep_default_na=False, nrows=MAX_TABLE_ROWS, chunksize=CSV_CHUNK_ROWS)
+    with reader:
+        header_sent = False
+        for chunk in reader:
+            if not header_sent:
+                header_sent = True
+                yield chunk.columns
+            yield from chunk.itertuples(index=False, name=None)
 
-    # 1. Extract text from digital PDFs
-    if ext.endswith(".pdf"):
-        try:
-            with pdfplumber.open(file_path) as pdf:
-                full_text = "".join(page.extract_text() or "" for page in pdf.pages)
-            if full_text.strip():
-                logging.info("Successfully extracted text using pdfplumber.")
-                return full_text.strip()
-        except Exception as e:
-            logging.warning(f"pdfplumber failed: {e}. Falling back to Textract.")
+def _iter_xlsx_rows(file_path: str):
+    # Read-only mode streams rows from the sheet XML instead of building the whole workbook in memory.
+    # Like pd.read_excel, read the first worksheet rather than whichever tab was active when saved.
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True, max_row=MAX_TABLE_ROWS + 1)
+    finally:
+        workbook.close()
 
-    # 2. Extract text from Word documents (.docx)
-    elif ext.endswith(".docx"):
-        try:
-            doc = Document(file_path)
-            full_text = "\n".join([para.text for para in doc.paragraphs])
-            if full_text.strip():
-                logging.info("Successfully extracted text from DOCX.")
-                return full_text.strip()
-        except Exception as e:
-            logging.warning(f"python-docx failed: {e}. Falling back to Textract.")
+# Each extractor returns the extracted text, or "" to fall back to Textract OCR
+def _extract_pdf(file_path: str, max_pages: int) -> str:
+    """Extract text from digital PDFs with PDFium's native text extractor, falling back to pdfplumber."""
+    try:
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                parts = []
+                total_chars = 0
+                page_count = min(len(pdf), max_pages) if max_pages else len(pdf)
+                for index in range(page_count):
+                    page = pdf[index]
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range().replace("\r\n", "\n")  # PDFium reports CRLF line breaks
+                    textpage.close()
+                    page.close()
+                    parts.append(page_text)
+                    total_chars += len(page_text)
+                    if total_chars >= MAX_EXTRACTED_CHARS:
+                        logging.info(f"Collected {total_chars} characters after {len(parts)} pages; skipping the rest.")
+                        break
+            finally:
+                pdf.close()
+        full_text = "\n".join(parts).strip()
+        if full_text:
+            logging.info("Successfully extracted text using pypdfium2.")
+            return full_text
+    except Exception as e:
+        logging.warning(f"pypdfium2 failed: {e}. Trying pdfplumber.")
+    return _extract_pdf_with_pdfplumber(file_path, max_pages)
+
+def _extract_pdf_with_pdfplumber(file_path: str, max_pages: int) -> str:
+    # Slower layout-aware extraction, kept for PDFs PDFium can't read; imported lazily to keep startup fast
+    try:
+        import pdfplumber
+        pages = range(1, max_pages + 1) if max_pages else None
+        parts = []
+        total_chars = 0
+        with pdfplumber.open(file_path, pages=pages) as pdf:
+            for page in pdf.pages:
+                page_text = page.extract_text() or ""
+                page.close()  # Release the page's parsed objects before moving on
+                parts.append(page_text)
+                total_chars += len(page_text)
+                if total_chars >= MAX_EXTRACTED_CHARS:
+                    logging.info(f"Collected {total_chars} characters after {len(parts)} pages; skipping the rest.")
+                    break
+        full_text = "".join(parts).strip()
+        if full_text:
+            logging.info("Successfully extracted text using pdfplumber.")
+        return full_text
+    except Exception as e:
+        logging.warning(f"pdfplumber failed: {e}. Falling back to Textract.")
+        return ""
 
-    # 3. Extract from Excel and CSV (.xlsx, .csv)
-    elif ext.endswith(".xlsx") or ext.endswith(".csv"):
+def _extract_docx(file_path: str, max_pages: int) -> str:
+    """Extract text from Word documents (.docx)."""
+    try:
+        doc = Document(file_path)
+        full_text = "\n".join([para.text for para in doc.paragraphs]).strip()
+        if full_text:
+            logging.info("Successfully extracted text from DOCX.")
+        return full_text
+    except Exception as e:
+        logging.warning(f"python-docx failed: {e}. Falling back to Textract.")
+        return ""
+
+def _extract_table(rows_reader):
+    """Build a handler that extracts spreadsheet rows (.xlsx, .csv) as tab-separated text."""
+    def handler(file_path: str, max_pages: int) -> str:
         try:
-            if ext.endswith(".csv"):
-                df = pd.read_csv(file_path)
-            else:
-                df = pd.read_excel(file_path)
-            full_text = df.to_string(index=False)
-            if full_text.strip():
+            full_text = _rows_to_text(rows_reader(file_path)).strip()
+            if full_text:
                 logging.info("Successfully extracted text from Excel/CSV.")
-                return full_text.strip()
+            return full_text
         except Exception as e:
-            logging.warning(f"pandas failed to extract table: {e}. Falling back to Textract.")
+            logging.warning(f"Failed to extract table: {e}. Falling back to Textract.")
+            return ""
+    return handler
 
-    # 4. Extract from plain text files (.txt)
-    elif ext.endswith(".txt"):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                full_text = f.read()
-            if full_text.strip():
-                logging.info("Successfully extracted text from TXT file.")
-                return full_text.strip()
-        except Exception as e:
-            logging.warning(f"Failed to read TXT file: {e}. Falling back to Textract.")
+def _extract_txt(file_path: str, max_pages: int) -> str:
+    """Extract text from plain text files (.txt)."""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            full_text = f.read().strip()
+        if full_text:
+            logging.info("Successfully extracted text from TXT file.")
+        return full_text
+    except Exception as e:
+        logging.warning(f"Failed to read TXT file: {e}. Falling back to Textract.")
+        return ""
 
-    # 5. Extract from images (.png, .jpg, .jpeg)
-    elif ext.endswith((".png", ".jpg", ".jpeg")):
-        try:
-            image = Image.open(BytesIO(file_bytes))
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-            logging.info("Image opened successfully. Using Textract.")
-            # Skip PIL OCR — go directly to Textract for better multilingual OCR
-        except Exception as e:
-            logging.warning(f"PIL failed to open image: {e}. Falling back to Textract.")
+def _extract_image(file_path: str, max_pages: int) -> str:
+    """Check that an image (.png, .jpg, .jpeg) opens; its text always comes from Textract."""
+    try:
+        with Image.open(file_path) as image:
+            image.verify()
+        logging.info("Image opened successfully. Using Textract.")
+        # Skip PIL OCR — go directly to Textract for better multilingual OCR
+    except Exception as e:
+        logging.warning(f"PIL failed to open image: {e}. Falling back to Textract.")
+    return ""
+
+# Extension -> local extractor; anything else (RTF, PPTX, ODT, ...) goes straight to Textract
+EXTRACTORS = {
+    ".pdf": _extract_pdf,
+    ".docx": _extract_docx,
+    ".csv": _extract_table(_iter_csv_rows),
+    ".xlsx": _extract_table(_iter_xlsx_rows),
+    ".txt": _extract_txt,
+    ".png": _extract_image,
+    ".jpg": _extract_image,
+    ".jpeg": _extract_image,
+}
+
+def _file_digest(file_path: str) -> str:
+    """SHA-256 of a file's contents, the same key main computes while spooling uploads."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_path(digest: str, max_pages: int) -> str:
+    suffix = f"-p{max_pages}" if max_pages else ""
+    return os.path.join(EXTRACTION_CACHE_DIR, f"{digest}{suffix}.txt")
+
+def _store_cached_text(cache_path: str, text: str):
+    """Write atomically so concurrent workers never read a partial file."""
+    try:
+        os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False, dir=EXTRACTION_CACHE_DIR) as tmp:
+            tmp.write(text)
+        os.replace(tmp.name, cache_path)
+    except OSError as e:
+        logging.warning(f"Failed to write extraction cache {cache_path}: {e}")
 
-    # 6. Fallback: AWS Textract (for scans, images, poor PDFs, RTF, PPTX, ODT)
+class _AsyncTextractJob:
+    """Returned in place of text when a file needs an asynchronous Textract job that the caller should run."""
+
+def extract_text_from_upload(file_path: str, max_pages: int = MAX_PDF_PAGES, digest: str = None, run_async_jobs: bool = True) -> str:
+    """Extracts text from various formats. Falls back to AWS Textract OCR for scanned documents/images.
+
+    PDFs and spreadsheets are read incrementally and stop once MAX_EXTRACTED_CHARS have been collected, since
+    downstream analysis never looks further than that; max_pages additionally limits how many PDF pages are opened.
+    With EXTRACTION_CACHE_DIR set, results are cached on disk by content hash so re-uploads skip parsing and OCR;
+    pass the file's SHA-256 hex digest when it is already known, otherwise the file is hashed first.
+    With run_async_jobs=False, a file that needs an asynchronous Textract job returns an _AsyncTextractJob instead
+    of waiting minutes on it; extract_text_from_upload_async uses this to run the job outside its process pool.
+    """
+    if not EXTRACTION_CACHE_DIR:
+        return _extract_uncached(file_path, max_pages, run_async_jobs)
+
+    cache_path = _cache_path(digest or _file_digest(file_path), max_pages)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            logging.info("Using cached extraction result.")
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    text = _extract_uncached(file_path, max_pages, run_async_jobs)
+    if isinstance(text, str) and text:  # Failures aren't cached so they can be retried
+        _store_cached_text(cache_path, text)
+    return text
+
+def _extract_uncached(file_path: str, max_pages: int, run_async_jobs: bool = True) -> str:
+    ext = os.path.splitext(file_path)[1].lower()
+    extractor = EXTRACTORS.get(ext)
+    if extractor is not None:
+        full_text = extractor(file_path, max_pages)
+        if full_text:
+            return full_text
+    return _extract_with_textract(file_path, ext, max_pages, run_async_jobs)
+
+async def _run_async_textract_job(file_path: str, max_pages: int, digest: str = None) -> str:
+    """OCR a file that extract_text_from_upload deferred, caching the result like any other extraction."""
+    try:
+        text = "\n".join(await _poll_async_job(file_path))
+    except ClientError as e:
+        logging.error(f"AWS Textract API error ({e.response['Error']['Code']}): {e}")
+        return ""
+    except Exception as e:
+        logging.error(f"Unexpected Textract error: {e}")
+        return ""
+    if not text:
+        logging.warning("No text lines found in Textract response")
+        return ""
+    logging.info(f"Successfully extracted {len(text)} characters using Textract")
+    if EXTRACTION_CACHE_DIR:
+        cache_path = _cache_path(digest or await asyncio.to_thread(_file_digest, file_path), max_pages)
+        await asyncio.to_thread(_store_cached_text, cache_path, text)
+    return text
+
+def _extract_with_textract(file_path: str, ext: str, max_pages: int, run_async_jobs: bool = True) -> str:
+    """Fallback: AWS Textract (for scans, images, poor PDFs, RTF, PPTX, ODT)."""
     if textract_client is not None:
         logging.info("Using AWS Textract for OCR extraction.")
         try:
-            # Validate file size for Textract (max 10MB)
-            if len(file_bytes) > 10 * 1024 * 1024:
-                logging.error(f"File too large for Textract: {len(file_bytes)} bytes (max 10MB)")
-                return ""
-            
-            # Validate file format for Textract
-            if not ext.endswith(('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')):
-                logging.warning(f"File format {ext} may not be supported by Textract")
-            
-            response = textract_client.detect_document_text(
-                Document={"Bytes": file_bytes}
-            )
-            
-            if 'Blocks' not in response:
-                logging.warning("No text blocks found in Textract response")
-                return ""
-                
-            text_blocks = [block['Text'] for block in response['Blocks'] if block['BlockType'] == 'LINE']
+            file_size = os.path.getsize(file_path)
+            page_count = _pdf_page_count(file_path) if ext == ".pdf" else 1
+            if s3_client is not None and ext in ASYNC_TEXTRACT_EXTENSIONS and (
+                    file_size > TEXTRACT_MAX_BYTES or page_count > 1):
+                # Multi-page and oversized files go through an S3-backed job, which has no page or 10MB limit
+                if not run_async_jobs:
+                    return _AsyncTextractJob()
+                text_blocks = _detect_lines_async_job(file_path)
+            elif ext == ".pdf" and page_count == 1 and file_size <= TEXTRACT_MAX_BYTES:
+                # Textract reads single-page PDFs directly, at the scan's own resolution, so they aren't rasterized
+                with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                    text_blocks = _detect_lines(file_map)
+            elif ext == ".pdf":
+                # Other scanned PDFs are OCR'd per page, which also lifts the 10MB limit on the whole file
+                text_blocks = _ocr_pdf_pages(file_path, max_pages)
+            else:
+                # Validate file size for Textract (max 10MB) without reading the file into memory
+                if file_size > TEXTRACT_MAX_BYTES:
+                    logging.error(f"File too large for Textract: {file_size} bytes (max 10MB)")
+                    return ""
+
+                # Validate file format for Textract
+                if ext not in ('.png', '.jpg', '.jpeg', '.tiff', '.bmp'):
+                    logging.warning(f"File format {ext} may not be supported by Textract")
+
+                # Memory-map the spooled file so its contents aren't copied onto the Python heap
+                with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                    text_blocks = _detect_lines(file_map)
+
             if not text_blocks:
                 logging.warning("No text lines found in Textract response")
                 return ""
@@ -146,3 +382,177 @@ def extract_text_from_upload(file_path: str, file_bytes: bytes) -> str:
         logging.error("AWS Textract not available. Cannot process scanned documents or images.")
         logging.error("Please configure AWS credentials and region to enable OCR functionality.")
         return ""
+
+def _detect_lines(document) -> list:
+    """Run synchronous Textract OCR on a single-page document and return its text lines."""
+    response = textract_client.detect_document_text(Document={"Bytes": document})
+    return [block['Text'] for block in response.get('Blocks', []) if block['BlockType'] == 'LINE']
+
+def _pdf_page_count(file_path: str) -> int:
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+def _start_async_job(file_path: str) -> tuple:
+    """Upload a copy of the file to OCR_BUCKET and start a Textract text detection job on it."""
+    key = f"textract/{uuid.uuid4().hex}{os.path.splitext(file_path)[1].lower()}"
+    s3_client.upload_file(file_path, OCR_BUCKET, key)
+    try:
+        job_id = textract_client.start_document_text_detection(
+            DocumentLocation={"S3Object": {"Bucket": OCR_BUCKET, "Name": key}}
+        )["JobId"]
+    except BaseException:
+        _delete_ocr_upload(key)
+        raise
+    logging.info(f"Started Textract job {job_id}")
+    return key, job_id
+
+def _delete_ocr_upload(key: str):
+    try:
+        s3_client.delete_object(Bucket=OCR_BUCKET, Key=key)
+    except Exception as e:
+        logging.warning(f"Failed to delete s3://{OCR_BUCKET}/{key}: {e}")
+
+def _async_job_lines(job_id: str, response: dict) -> list:
+    """Page through the results of a finished job, starting from its final status response."""
+    if response["JobStatus"] != "SUCCEEDED":
+        logging.error(f"Textract job {job_id} ended with status {response['JobStatus']}: {response.get('StatusMessage')}")
+        return []
+    lines = []
+    while True:
+        lines.extend(block['Text'] for block in response.get('Blocks', []) if block['BlockType'] == 'LINE')
+        next_token = response.get("NextToken")
+        if not next_token:
+            return lines
+        response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
+
+def _detect_lines_async_job(file_path: str) -> list:
+    """OCR a file with an asynchronous Textract job on a copy uploaded to OCR_BUCKET and return its text lines.
+
+    Polls with exponential backoff until the job finishes, then pages through the results. The S3 copy is
+    removed afterwards. Blocks the calling thread throughout; async callers use _poll_async_job instead.
+    """
+    key, job_id = _start_async_job(file_path)
+    try:
+        deadline = time.monotonic() + TEXTRACT_JOB_TIMEOUT_SECONDS
+        delay = 1
+        while True:
+            time.sleep(delay)
+            response = textract_client.get_document_text_detection(JobId=job_id)
+            if response["JobStatus"] != "IN_PROGRESS":
+                return _async_job_lines(job_id, response)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Textract job {job_id} did not finish within {TEXTRACT_JOB_TIMEOUT_SECONDS}s")
+            delay = min(delay * 2, TEXTRACT_POLL_MAX_SECONDS)
+    finally:
+        _delete_ocr_upload(key)
+
+async def _poll_async_job(file_path: str) -> list:
+    """Like _detect_lines_async_job, but waits between polls on the event loop.
+
+    Only the individual AWS calls run in threads, so a job never holds an executor thread for its whole duration,
+    and cancelling the awaiting request stops the polling.
+    """
+    key, job_id = await asyncio.to_thread(_start_async_job, file_path)
+    try:
+        deadline = time.monotonic() + TEXTRACT_JOB_TIMEOUT_SECONDS
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            response = await asyncio.to_thread(textract_client.get_document_text_detection, JobId=job_id)
+            if response["JobStatus"] != "IN_PROGRESS":
+                return await asyncio.to_thread(_async_job_lines, job_id, response)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Textract job {job_id} did not finish within {TEXTRACT_JOB_TIMEOUT_SECONDS}s")
+            delay = min(delay * 2, TEXTRACT_POLL_MAX_SECONDS)
+    finally:
+        await asyncio.to_thread(_delete_ocr_upload, key)
+
+def _render_page(pdf, index: int) -> bytes:
+    with _PDFIUM_LOCK:
+        page = pdf[index]
+        try:
+            bitmap = page.render(scale=OCR_RENDER_SCALE)
+            # Copy out of PDFium's buffer so the bitmap can be freed here and the PNG encoded without the lock
+            image = bitmap.to_pil().copy()
+            bitmap.close()
+        finally:
+            page.close()
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=False)
+    if buffer.tell() > TEXTRACT_MAX_BYTES:
+        # Dense pages (photos, halftone scans) can exceed the limit as PNG at 300 DPI; JPEG keeps them well under it
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=OCR_JPEG_QUALITY)
+    return buffer.getvalue()
+
+def _ocr_pdf_pages(file_path: str, max_pages: int = None) -> list:
+    """OCR a scanned PDF page by page, with up to OCR_PAGE_CONCURRENCY Textract calls in flight.
+
+    Synchronous Textract only accepts single-page PDFs under 10MB, so each page is rasterized and sent on its own.
+    Pages are rendered in this process while earlier pages are still being OCR'd; lines come back in page order.
+    Like the digital-PDF path, pages are processed in windows of OCR_PAGE_CONCURRENCY and no further windows are
+    submitted once MAX_EXTRACTED_CHARS have been collected.
+    """
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        page_count = min(len(pdf), max_pages) if max_pages else len(pdf)
+    try:
+        logging.info(f"OCR of up to {page_count} PDF pages with Textract...")
+        lines = []
+        total_chars = 0
+        with ThreadPoolExecutor(max_workers=OCR_PAGE_CONCURRENCY) as pool:
+            for start in range(0, page_count, OCR_PAGE_CONCURRENCY):
+                window = range(start, min(start + OCR_PAGE_CONCURRENCY, page_count))
+                futures = [pool.submit(_detect_lines, _render_page(pdf, index)) for index in window]
+                for future in futures:
+                    page_lines = future.result()
+                    lines.extend(page_lines)
+                    total_chars += sum(len(line) + 1 for line in page_lines)
+                if total_chars >= MAX_EXTRACTED_CHARS:
+                    logging.info(f"Collected {total_chars} characters after {window.stop} pages; skipping the rest.")
+                    break
+        return lines
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+async def extract_text_from_upload_async(file_path: str, executor=None, digest: str = None) -> str:
+    """Run extract_text_from_upload without blocking the event loop.
+
+    Pass a ProcessPoolExecutor for CPU-bound parsing (pdfplumber holds the GIL); otherwise a worker thread is used,
+    which is enough when extraction mostly waits on Textract. Asynchronous Textract jobs only wait on AWS, so they
+    are polled from the event loop rather than holding an executor process or thread for minutes.
+    """
+    extract = functools.partial(extract_text_from_upload, file_path, digest=digest, run_async_jobs=False)
+    if executor is None:
+        text = await asyncio.to_thread(extract)
+    else:
+        text = await asyncio.get_running_loop().run_in_executor(executor, extract)
+    if isinstance(text, _AsyncTextractJob):
+        return await _run_async_textract_job(file_path, MAX_PDF_PAGES, digest)
+    return text
+
+async def extract_batch(file_paths: list, executor=None, digests: list = None) -> list:
+    """Extract text from many files concurrently, returning results in input order.
+
+    Parsing-heavy formats (PDF, DOCX, XLSX, ...) run in executor, ideally a ProcessPoolExecutor sized to the CPU
+    count; images only wait on Textract, so they run in threads with at most OCR_BATCH_CONCURRENCY in flight.
+    A file that fails to extract yields its exception in place of the text. digests optionally gives each file's
+    SHA-256 hex digest for the extraction cache.
+    This is a library entry point for bulk ingestion jobs; the HTTP endpoints extract each upload as it arrives.
+    """
+    ocr_slots = asyncio.Semaphore(OCR_BATCH_CONCURRENCY)
+
+    async def extract_one(file_path: str, digest: str) -> str:
+        if os.path.splitext(file_path)[1].lower() in OCR_ONLY_EXTENSIONS:
+            async with ocr_slots:
+                return await extract_text_from_upload_async(file_path, digest=digest)
+        return await extract_text_from_upload_async(file_path, executor, digest)
+
+    logging.info(f"Extracting text from {len(file_paths)} files...")
+    digests = digests or [None] * len(file_paths)
+    return await asyncio.gather(*[extract_one(file_path, digest) for file_path, digest in zip(file_paths, digests)], return_exceptions=True)